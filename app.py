@@ -1,32 +1,278 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, abort
+from flask import (
+    Blueprint, Flask, Response, render_template, request, redirect, url_for, flash, send_file, abort, jsonify,
+    stream_with_context, g, session, current_app, has_app_context, has_request_context,
+)
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as BindSession
+from sqlalchemy.pool import QueuePool
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from datetime import datetime, date
-from sqlalchemy import text, case, or_, inspect
+from datetime import datetime, date, timedelta
+from sqlalchemy import event, exc as sa_exc, text, case, or_, and_, func, inspect, select, insert, update, union, table, column, literal_column, tuple_
 import os
-from fpdf import FPDF
-from io import BytesIO
-from functools import wraps
+import io
+import json
+import hashlib
+import uuid
+import zlib
+import tempfile
+import click
+import threading
+import time
+import multiprocessing
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from bisect import bisect_right
+from functools import wraps, lru_cache
+from contextlib import contextmanager
 import csv
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side
+import unicodedata
+from urllib.parse import quote as url_quote
 
 # --------- App & DB setup ---------
-app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "dev-key")
+# fpdf e openpyxl só são importados dentro dos exports/importação (boot mais rápido).
+# Rotas, hooks e comandos ficam no blueprint "main"; create_app() monta cada app.
+bp = Blueprint("main", __name__, cli_group=None)
 
-# Database configuration: prefer DATABASE_URL/RENDER_DATABASE_URL (e.g. Render PostgreSQL),
-# fallback to local SQLite for development.
-db_url = os.environ.get("DATABASE_URL") or os.environ.get("RENDER_DATABASE_URL") or "sqlite:///data.db"
-if db_url.startswith("postgres://"):
-    db_url = db_url.replace("postgres://", "postgresql://", 1)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = db_url
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+class RoutingSession(BindSession):
+    """Sessão que lê da réplica (bind "replica") nas rotas marcadas com @read_replica.
+
+    Flush e INSERT/UPDATE/DELETE sempre vão para o primário; depois da primeira
+    escrita, o resto da requisição também lê do primário (read-your-writes).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or (clause is not None and getattr(clause, "is_dml", False)):
+                g.db_wrote = True
+            elif g.get("db_replica") and not g.get("db_wrote"):
+                return self._db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+login_manager = LoginManager()
+login_manager.login_view = "main.login"
+
+
+# --------- Pool de conexões ---------
+class PoolStats:
+    """Métricas do pool de conexões deste processo (uso e espera no checkout)."""
+
+    SLOW_WAIT = 0.01  # s
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.in_use_peak = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.slow_waits = 0
+        self.timeouts = 0
+
+    def waited(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if seconds >= self.SLOW_WAIT:
+                self.slow_waits += 1
+            if timed_out:
+                self.timeouts += 1
+
+    def checked_out(self):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.in_use_peak = max(self.in_use_peak, self.in_use)
+
+    def checked_in(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def connected(self):
+        with self._lock:
+            self.connects += 1
+
+    def snapshot(self, pool) -> dict:
+        with self._lock:
+            data = {
+                "pid": os.getpid(),
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "in_use": self.in_use,
+                "in_use_peak": self.in_use_peak,
+                "wait_avg_ms": round(self.wait_total / self.waits * 1000, 3) if self.waits else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "slow_waits": self.slow_waits,
+                "timeouts": self.timeouts,
+            }
+        if isinstance(pool, QueuePool):
+            data.update(pool_size=pool.size(), max_overflow=pool._max_overflow,
+                        overflow=pool.overflow(), idle=pool.checkedin())
+        return data
+
+
+pool_stats = PoolStats()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool que mede quanto cada checkout esperou por uma conexão livre."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            entry = super()._do_get()
+        except sa_exc.TimeoutError:
+            pool_stats.waited(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.waited(time.perf_counter() - started)
+        return entry
+
+
+@event.listens_for(MeteredQueuePool, "connect")
+def _pool_connect(dbapi_conn, record):
+    pool_stats.connected()
+
+
+@event.listens_for(MeteredQueuePool, "checkout")
+def _pool_checkout(dbapi_conn, record, proxy):
+    pool_stats.checked_out()
+
+
+@event.listens_for(MeteredQueuePool, "checkin")
+def _pool_checkin(dbapi_conn, record):
+    pool_stats.checked_in()
+
+
+def engine_options(db_url: str) -> dict:
+    """Opções do engine pelo ambiente (DB_POOL_*).
+
+    Conexões por worker = DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW; some por todos os
+    processos do gunicorn para ficar abaixo do limite do Postgres. SQLite usa o
+    pool padrão.
+    """
+    if db_url.startswith("sqlite"):
+        return {}
+    options = {
+        "poolclass": MeteredQueuePool,
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.environ.get("DB_POOL_MAX_OVERFLOW", "5")),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", "10")),
+        # o Postgres do Render derruba conexões ociosas; recicla antes e testa no checkout
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+    }
+    return options
+
+
+@event.listens_for(RoutingSession, "after_begin")
+def request_statement_timeout(session, transaction, connection):
+    """Limite por comando (DB_STATEMENT_TIMEOUT_MS) só nas requisições web, no Postgres.
+
+    SET LOCAL vale até o fim da transação, então a conexão volta ao pool sem ele:
+    `flask migrate`, os comandos da CLI e os workers de export rodam sem limite.
+    """
+    if connection.dialect.name != "postgresql" or not has_request_context() or g.get("migrating"):
+        return
+    timeout = current_app.config["DB_STATEMENT_TIMEOUT_MS"]
+    if timeout > 0:
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+def sqlite_pragmas() -> dict:
+    """PRAGMAs aplicados em cada conexão SQLite (SQLITE_MODE=wal, o padrão; "default" desliga)."""
+    if os.environ.get("SQLITE_MODE", "wal") != "wal":
+        return {}
+    return {
+        # leitores não bloqueiam o escritor (e vice-versa); com WAL, NORMAL já é seguro contra corrupção
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        # espera o lock em vez de falhar na hora com "database is locked"
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+        "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+        "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", "-65536")),  # negativo = KiB
+    }
+
+
+def sqlite_on_connect(pragmas: dict):
+    def apply(dbapi_conn, record):
+        cursor = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+    return apply
+
+
+def create_app(config: dict | None = None) -> Flask:
+    """Monta um app configurado pelo ambiente; ``config`` sobrescreve (ex.: testes).
+
+    Não abre conexão com o banco: o schema é checado no primeiro request de
+    cada processo (ensure_schema), então `gunicorn --preload` pode importar o
+    módulo antes do fork.
+    """
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "dev-key")
+
+    # Database configuration: prefer DATABASE_URL/RENDER_DATABASE_URL (e.g. Render PostgreSQL),
+    # fallback to local SQLite for development.
+    db_url = os.environ.get("DATABASE_URL") or os.environ.get("RENDER_DATABASE_URL") or "sqlite:///data.db"
+    if db_url.startswith("postgres://"):
+        db_url = db_url.replace("postgres://", "postgresql://", 1)
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # réplica só de leitura (opcional) para a listagem, exports e invoices
+    replica_url = os.environ.get("DATABASE_REPLICA_URL")
+    if replica_url:
+        if replica_url.startswith("postgres://"):
+            replica_url = replica_url.replace("postgres://", "postgresql://", 1)
+        app.config["SQLALCHEMY_BINDS"] = {"replica": {"url": replica_url, **engine_options(replica_url)}}
+    # depois de uma escrita, por quantos segundos o mesmo usuário ainda lê do primário
+    app.config["REPLICA_STICKY_SECONDS"] = int(os.environ.get("REPLICA_STICKY_SECONDS", "10"))
+    # quantidade de lançamentos por página na tela principal
+    app.config["RECORDS_PER_PAGE"] = int(os.environ.get("RECORDS_PER_PAGE", "100"))
+    # exports em segundo plano: pasta dos arquivos, validade (s) e processos do pool (0 = na própria requisição)
+    app.config["EXPORT_DIR"] = os.environ.get("EXPORT_DIR") or os.path.join(app.instance_path, "exports")
+    app.config["EXPORT_TTL"] = int(os.environ.get("EXPORT_TTL", "86400"))
+    app.config["EXPORT_WORKERS"] = int(os.environ.get("EXPORT_WORKERS", "2"))
+    # job "running" há mais que isso (s) é dado como morto; "queued" sem dono há mais que isso é redespachado
+    app.config["EXPORT_JOB_TIMEOUT"] = int(os.environ.get("EXPORT_JOB_TIMEOUT", "1800"))
+    app.config["EXPORT_REQUEUE_AFTER"] = int(os.environ.get("EXPORT_REQUEUE_AFTER", "60"))
+    # validade (s) do cache das listas de empresas/splicers dos filtros
+    app.config["DIMENSION_CACHE_TTL"] = int(os.environ.get("DIMENSION_CACHE_TTL", "300"))
+    # limite (ms) de cada comando SQL nas requisições web (Postgres); 0 desliga
+    app.config["DB_STATEMENT_TIMEOUT_MS"] = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "60000"))
+    # aplica migrações pendentes no primeiro request (sob lock); com 0 só o `flask migrate` migra
+    app.config["AUTO_MIGRATE"] = os.environ.get("AUTO_MIGRATE", "1") == "1"
+
+    app.config.update(config or {})
+    db_url = app.config["SQLALCHEMY_DATABASE_URI"]
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(db_url))
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    # caches por app (snapshots de preço, listas, schema já checado...)
+    app.extensions["splicer"] = {"search_maps": lru_cache(maxsize=1024)(query_maps)}
+    pragmas = sqlite_pragmas() if db_url.startswith("sqlite") else None
+    if pragmas:
+        with app.app_context():
+            event.listen(db.engine, "connect", sqlite_on_connect(pragmas))
+    return app
+
+
+def app_cache() -> dict:
+    """Caches do app atual (cada app criado por create_app tem os seus)."""
+    return current_app.extensions["splicer"]
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = "login"
 
 # --------- Models ---------
 class User(UserMixin, db.Model):
@@ -84,8 +330,52 @@ class CompanyMap(db.Model):
     company = db.Column(db.String(120), nullable=False, index=True)
     name = db.Column(db.String(200), nullable=False)
 
+    # busca por prefixo do autocomplete (/api/maps)
+    __table_args__ = (db.Index("ix_company_map_company_name", "company", "name"),)
+
+
+class CacheVersion(db.Model):
+    """Contador de versão por nome (ex.: "pricing"), usado para invalidar caches dos workers."""
+    name = db.Column(db.String(60), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# índices compostos de Record (nome -> colunas), cobrindo os filtros da listagem,
+# dos exports e a checagem de duplicidade do lançamento
+RECORD_INDEXES = {
+    "ix_record_created": ("created_date", "id"),
+    "ix_record_company_created": ("company", "created_date", "id"),
+    "ix_record_splicer_created": ("splicer", "created_date", "id"),
+    "ix_record_company_splicer_created": ("company", "splicer", "created_date"),
+}
+
+
+class ExportJob(db.Model):
+    """Fila de exports gerados em segundo plano (PDF, invoice, Excel)."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    params = db.Column(db.Text, nullable=True)  # filtros em JSON
+    user_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="queued", index=True)  # queued / running / done / failed
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    file_path = db.Column(db.String(500), nullable=True)
+    download_name = db.Column(db.String(200), nullable=True)
+    mimetype = db.Column(db.String(120), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # heartbeat do processo que tem o job no pool; "queued" com heartbeat velho ficou sem dono
+    dispatched_at = db.Column(db.DateTime, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+
 
 class Record(db.Model):
+    __table_args__ = tuple(db.Index(name, *cols) for name, cols in RECORD_INDEXES.items()) + (
+        db.Index("ux_record_client_key", "client_key", unique=True),
+        db.Index("ux_record_fingerprint", "fingerprint", unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     map = db.Column(db.String(200))
     type = db.Column(db.String(120))
@@ -98,6 +388,325 @@ class Record(db.Model):
     price_device_usd = db.Column(db.Float, default=0.0)
     total_usd = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # chave de idempotência gerada pelo aparelho de campo (/api/sync)
+    client_key = db.Column(db.String(64), nullable=True)
+    # hash de (empresa, map, dispositivo) normalizados; só o primeiro lançamento
+    # de cada chave fica com ele (duplicatas confirmadas gravam NULL)
+    fingerprint = db.Column(db.String(40), nullable=True)
+
+class RecordDailyRollup(db.Model):
+    """Totais de Record por dia + empresa + splicer + mapa + dispositivo.
+
+    Mantido junto com cada lançamento (ver rollup_apply); relatórios somam
+    estas linhas em vez de varrer todos os registros. Uma linha por chave: os
+    índices únicos fazem escritas concorrentes somarem na mesma linha (upsert).
+    """
+    __tablename__ = "record_daily_rollup"
+    __table_args__ = (
+        db.Index("ux_rollup_key", "day", "company", "splicer", "map", "device", unique=True),
+        # day NULL nunca conflita no índice acima: lançamentos sem data têm o próprio
+        db.Index("ux_rollup_undated_key", "company", "splicer", "map", "device", unique=True,
+                 sqlite_where=text("day IS NULL"), postgresql_where=text("day IS NULL")),
+        db.Index("ix_rollup_company_day", "company", "day"),
+        db.Index("ix_rollup_splicer_day", "splicer", "day"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=True)  # None = lançamento sem data
+    company = db.Column(db.String(120), nullable=False, default="")
+    splicer = db.Column(db.String(120), nullable=False, default="")
+    map = db.Column(db.String(200), nullable=False, default="")  # sem espaços nas pontas
+    device = db.Column(db.String(120), nullable=False, default="")  # sem espaços nas pontas
+    record_count = db.Column(db.Integer, nullable=False, default=0)
+    splices = db.Column(db.Integer, nullable=False, default=0)
+    hub_count = db.Column(db.Integer, nullable=False, default=0)
+    total_usd = db.Column(db.Float, nullable=False, default=0.0)
+    price_device_usd = db.Column(db.Float, nullable=False, default=0.0)
+
+
+# --------- Versões de cache ---------
+def current_version(name: str) -> int:
+    row = db.session.get(CacheVersion, name)
+    return int(row.version) if row else 0
+
+
+def bump_version(name: str):
+    """Incrementa a versão (sem commit: vai junto com a transação da rota)."""
+    row = db.session.get(CacheVersion, name)
+    if row:
+        row.version = CacheVersion.version + 1
+    else:
+        db.session.add(CacheVersion(name=name, version=1))
+
+
+# --------- Fingerprint de duplicidade ---------
+def dialect_insert(model):
+    """INSERT do dialeto atual (Postgres ou SQLite), que aceita ON CONFLICT."""
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert_
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert_
+    return dialect_insert_(model.__table__)
+
+
+def record_fingerprint(company: str | None, map_val: str | None, device: str | None) -> str | None:
+    """Hash de (empresa, map, dispositivo) normalizados; None se faltar map ou dispositivo."""
+    map_val, device = (map_val or "").strip().lower(), (device or "").strip().lower()
+    if not map_val or not device:
+        return None
+    raw = "\x1f".join(((company or "").strip().lower(), map_val, device))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def insert_records(rows: list[dict], keep_duplicates: bool = False) -> list:
+    """Insere lançamentos detectando duplicidade no próprio INSERT.
+
+    Cada linha tenta ficar com seu fingerprint via INSERT ... ON CONFLICT DO
+    NOTHING no índice único. Quem perde (já existe lançamento com a mesma
+    chave) é gravado sem fingerprint se keep_duplicates, senão fica de fora.
+    Retorna os ids na ordem de `rows` (None = não gravada).
+    """
+    ids = [None] * len(rows)
+    claims, rest, first = [], [], set()
+    for i, row in enumerate(rows):
+        fp = row.get("fingerprint")
+        if fp and fp not in first:
+            first.add(fp)
+            claims.append(i)
+        elif not fp or keep_duplicates:
+            rest.append(i)
+
+    if claims:
+        stmt = (
+            dialect_insert(Record)
+            .values([rows[i] for i in claims])
+            .on_conflict_do_nothing(index_elements=["fingerprint"])
+            .returning(Record.id, Record.fingerprint)
+        )
+        got = {fp: rid for rid, fp in db.session.execute(stmt)}
+        for i in claims:
+            ids[i] = got.get(rows[i]["fingerprint"])
+            if ids[i] is None and keep_duplicates:
+                rest.append(i)
+
+    if rest:
+        rest.sort()
+        new_ids = db.session.scalars(
+            insert(Record).returning(Record.id, sort_by_parameter_order=True),
+            [{**rows[i], "fingerprint": None} for i in rest],
+        ).all()
+        for i, rid in zip(rest, new_ids):
+            ids[i] = rid
+    return ids
+
+
+def claim_fingerprint(rec, fp: str) -> bool:
+    """Dá o fingerprint a `rec` se nenhum lançamento tiver a chave; True se conseguiu.
+
+    UPDATE condicional (NOT EXISTS) num savepoint: duas edições concorrentes
+    para a mesma chave não passam as duas por uma checagem prévia, e quem perde
+    a corrida no índice único fica com NULL em vez de derrubar a transação.
+    """
+    holder = Record.__table__.alias("holder")
+    try:
+        with db.session.begin_nested():
+            claimed = db.session.execute(
+                update(Record)
+                .where(Record.id == rec.id, ~select(holder.c.id).where(holder.c.fingerprint == fp).exists())
+                .values(fingerprint=fp)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+    except sa_exc.IntegrityError:
+        claimed = 0
+    db.session.expire(rec, ["fingerprint"])
+    return bool(claimed)
+
+
+def release_fingerprint(rec):
+    """Solta o fingerprint de um lançamento (exclusão ou mudança de chave).
+
+    A duplicata confirmada mais antiga com a mesma chave normalizada herda o
+    fingerprint, para que novos lançamentos continuem sendo avisados.
+    """
+    fp = rec.fingerprint
+    if not fp:
+        return
+    rec.fingerprint = None
+    db.session.flush()
+
+    def norm(col):
+        return func.lower(func.trim(func.coalesce(col, literal_column("''"))))
+
+    candidates = Record.query.filter(
+        norm(Record.map) == (rec.map or "").strip().lower(),
+        norm(Record.device) == (rec.device or "").strip().lower(),
+        norm(Record.company) == (rec.company or "").strip().lower(),
+        Record.fingerprint.is_(None), Record.id != rec.id,
+    ).order_by(Record.id)
+    for heir in candidates:
+        # o lower() do SQLite só converte ASCII: confere com o mesmo cálculo do fingerprint
+        if record_fingerprint(heir.company, heir.map, heir.device) == fp:
+            claim_fingerprint(heir, fp)
+            return
+
+
+def backfill_fingerprints(chunk_size: int = 5000) -> int:
+    """Preenche o fingerprint dos lançamentos antigos (o mais antigo de cada chave fica com ele)."""
+    seen = {fp for (fp,) in db.session.query(Record.fingerprint).filter(Record.fingerprint.isnot(None))}
+    last_id, updated = 0, 0
+    while True:
+        rows = db.session.query(Record.id, Record.company, Record.map, Record.device).filter(
+            Record.fingerprint.is_(None), Record.id > last_id
+        ).order_by(Record.id).limit(chunk_size).all()
+        if not rows:
+            break
+        mappings = []
+        for rid, company, map_val, device in rows:
+            fp = record_fingerprint(company, map_val, device)
+            if fp and fp not in seen:
+                seen.add(fp)
+                mappings.append({"id": rid, "fingerprint": fp})
+        db.session.bulk_update_mappings(Record, mappings)
+        db.session.commit()
+        updated += len(mappings)
+        last_id = rows[-1][0]
+    return updated
+
+
+# --------- Rollup diário ---------
+def _trimmed(col):
+    # literal_column em vez de bind param: o GROUP BY do Postgres exige a mesma expressão do SELECT
+    return func.coalesce(func.trim(col), literal_column("''"))
+
+
+def _day(col):
+    # date() existe tanto no SQLite (texto 'YYYY-MM-DD') quanto no Postgres (tipo date)
+    return func.date(col)
+
+
+def rollup_apply(rec, sign: int = 1):
+    """Soma (sign=1) ou subtrai (sign=-1) um lançamento do rollup, na transação corrente."""
+    rollup_apply_many([rec], sign)
+
+
+ROLLUP_TOTALS = ("record_count", "splices", "hub_count", "total_usd", "price_device_usd")
+
+
+def rollup_key(rec) -> tuple:
+    """Chave do rollup de um lançamento (dia, empresa, splicer, mapa, dispositivo)."""
+    day = rec.created_date.date() if rec.created_date else None
+    return (day, rec.company or "", rec.splicer or "", (rec.map or "").strip(), (rec.device or "").strip())
+
+
+def rollup_apply_many(recs, sign: int = 1):
+    """Como rollup_apply, para vários lançamentos: uma consulta e um upsert em lote."""
+    pending = {}
+    for rec in recs:
+        deltas = pending.setdefault(rollup_key(rec), dict.fromkeys(ROLLUP_TOTALS, 0))
+        deltas["record_count"] += sign
+        deltas["splices"] += sign * int(rec.splices or 0)
+        deltas["hub_count"] += sign if (rec.type or "").upper() == "HUB" else 0
+        deltas["total_usd"] += sign * float(rec.total_usd or 0.0)
+        deltas["price_device_usd"] += sign * float(rec.price_device_usd or 0.0)
+    rollup_add(pending)
+
+
+def rollup_add(pending: dict):
+    """Soma {chave do rollup: {coluna: delta}} no rollup, na transação corrente.
+
+    O INSERT ... ON CONFLICT DO UPDATE soma na linha da chave, mesmo que outra
+    transação a tenha criado depois da consulta.
+    """
+    R = RecordDailyRollup
+    if not pending:
+        return
+
+    days = {k[0] for k in pending}
+    day_cond = R.day.in_([d for d in days if d is not None])
+    if None in days:
+        day_cond = or_(day_cond, R.day.is_(None))
+    counts = dict(
+        ((day, company, splicer, map_, device), count)
+        for day, company, splicer, map_, device, count in db.session.execute(
+            select(R.day, R.company, R.splicer, R.map, R.device, R.record_count).where(
+                day_cond,
+                tuple_(R.company, R.splicer, R.map, R.device).in_({k[1:] for k in pending}),
+            )
+        )
+    )
+
+    dated, undated = [], []
+    # (empresa, splicer) que passaram a ter lançamentos; se alguma linha zerou, um nome pode ter sumido
+    appeared, emptied = set(), False
+    for key, deltas in pending.items():
+        count = counts.get(key) or 0
+        added = deltas.get("record_count", 0)
+        if count <= 0 < count + added:
+            appeared.add(key[1:3])
+        elif count > 0 >= count + added:
+            emptied = True
+        day, company, splicer, map_, device = key
+        (dated if day is not None else undated).append(
+            dict(dict.fromkeys(ROLLUP_TOTALS, 0), day=day, company=company, splicer=splicer, map=map_, device=device,
+                 **deltas))
+
+    cols = R.__table__.c
+    for values, key_cols, where in (
+        (dated, [cols.day, cols.company, cols.splicer, cols.map, cols.device], None),
+        (undated, [cols.company, cols.splicer, cols.map, cols.device], cols.day.is_(None)),
+    ):
+        if not values:
+            continue
+        stmt = dialect_insert(R)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_cols, index_where=where,
+            set_={k: cols[k] + stmt.excluded[k] for k in ROLLUP_TOTALS},
+        )
+        db.session.execute(stmt, values)
+    # muda o que aparece nas listas de filtro: invalida o cache dos workers
+    cache = app_cache().get("dimensions")
+    if emptied or (appeared and (cache is None or any(not cache.knows(c, s) for c, s in appeared))):
+        bump_version("dimensions")
+
+
+def rebuild_rollup(company: str | None = None, start_dt=None, end_dt=None) -> int:
+    """Recalcula o rollup a partir de Record (tudo, ou só a empresa / os dias informados)."""
+    R = RecordDailyRollup
+    day_k = _day(Record.created_date)
+    map_k = _trimmed(Record.map)
+    device_k = _trimmed(Record.device)
+    company_k = func.coalesce(Record.company, literal_column("''"))
+    splicer_k = func.coalesce(Record.splicer, literal_column("''"))
+
+    delete_q = R.query
+    source = select(
+        day_k, company_k, splicer_k, map_k, device_k,
+        func.count(Record.id),
+        func.coalesce(func.sum(Record.splices), 0),
+        func.coalesce(func.sum(case((func.upper(Record.type) == "HUB", 1), else_=0)), 0),
+        func.coalesce(func.sum(Record.total_usd), 0.0),
+        func.coalesce(func.sum(Record.price_device_usd), 0.0),
+    ).group_by(day_k, company_k, splicer_k, map_k, device_k)
+    if company:
+        delete_q = delete_q.filter(R.company == company)
+        source = source.where(Record.company == company)
+    # o rollup é por dia: o intervalo é estendido para os dias inteiros
+    if start_dt:
+        delete_q = delete_q.filter(R.day >= start_dt.date())
+        source = source.where(Record.created_date >= datetime.combine(start_dt.date(), datetime.min.time()))
+    if end_dt:
+        delete_q = delete_q.filter(R.day <= end_dt.date())
+        source = source.where(Record.created_date < datetime.combine(end_dt.date() + timedelta(days=1), datetime.min.time()))
+
+    delete_q.delete(synchronize_session=False)
+    result = db.session.execute(insert(R).from_select(
+        ["day", "company", "splicer", "map", "device", *ROLLUP_TOTALS],
+        source,
+    ))
+    bump_version("dimensions")
+    db.session.commit()
+    return result.rowcount
+
 
 # --------- User loader ---------
 @login_manager.user_loader
@@ -107,37 +716,262 @@ def load_user(user_id: str):
     except Exception:
         return None
 
-# --------- DB init & migrations simples ---------
-with app.app_context():
+# --------- Migrações de schema ---------
+class SchemaVersion(db.Model):
+    """Passos de migração já aplicados (uma linha por versão)."""
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+def _ensure_column(table, col, typ):
+    """Garante que uma coluna exista na tabela informada (True se acabou de ser criada)."""
+    existing = [c["name"] for c in inspect(db.engine).get_columns(table)]
+    if col not in existing:
+        # Em Postgres, usar aspas duplas no nome da tabela evita problemas de case
+        db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {col} {typ}'))
+        db.session.commit()
+        return True
+    return False
+
+
+def _ensure_index(name, table, cols, unique=False):
+    """Garante que um índice exista (IF NOT EXISTS vale em SQLite e Postgres)."""
+    col_sql = ", ".join(f'"{c}"' for c in cols)
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    db.session.execute(text(f'CREATE {kind} IF NOT EXISTS {name} ON "{table}" ({col_sql})'))
+    db.session.commit()
+
+
+def migrate_tables():
     db.create_all()
 
+
+def migrate_legacy_columns():
+    # colunas acrescentadas depois da primeira versão (funciona tanto em SQLite quanto em Postgres)
+    _ensure_column("record", "company", "VARCHAR(120)")
+    _ensure_column("device_type", "company", "VARCHAR(120)")
+    _ensure_column("splice_tier", "company", "VARCHAR(120)")
+    _ensure_column("company_config", "invoice_address", "TEXT")
+    _ensure_column("user", "is_admin", "BOOLEAN")
+    _ensure_column("user", "splicer_name", "VARCHAR(120)")
+    _ensure_column("record", "client_key", "VARCHAR(64)")
+    if _ensure_column("record", "fingerprint", "VARCHAR(40)"):
+        backfill_fingerprints()
+
+
+def migrate_indexes():
+    for name, cols in RECORD_INDEXES.items():
+        _ensure_index(name, "record", cols)
+    _ensure_index("ix_company_map_company_name", "company_map", ("company", "name"))
+    _ensure_index("ux_record_client_key", "record", ("client_key",), unique=True)
+    _ensure_index("ux_record_fingerprint", "record", ("fingerprint",), unique=True)
+
+
+def migrate_search_index():
+    """Prepara a busca por trecho em map/device.
+
+    Postgres: índices GIN com pg_trgm (o próprio ILIKE '%...%' passa a usá-los).
+    SQLite: tabela FTS5 (tokenizer trigram) sincronizada por triggers.
+    Se a extensão ou o FTS5 faltarem, a exceção sobe: o passo não é gravado em
+    schema_version e é tentado de novo, em vez de a busca ficar no ILIKE sem aviso.
+    """
+    dialect = db.engine.dialect.name
+    try:
+        if dialect == "postgresql":
+            db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for col in ("map", "device"):
+                db.session.execute(text(
+                    f'CREATE INDEX IF NOT EXISTS ix_record_{col}_trgm ON "record" USING gin ({col} gin_trgm_ops)'
+                ))
+            db.session.commit()
+        elif dialect == "sqlite":
+            exists = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'record_fts'"
+            )).first()
+            if not exists:
+                db.session.execute(text(
+                    "CREATE VIRTUAL TABLE record_fts USING fts5("
+                    "map, device, content='record', content_rowid='id', tokenize='trigram')"
+                ))
+                db.session.execute(text("INSERT INTO record_fts(record_fts) VALUES ('rebuild')"))
+            db.session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS record_fts_ai AFTER INSERT ON record BEGIN "
+                "INSERT INTO record_fts(rowid, map, device) VALUES (new.id, new.map, new.device); END"
+            ))
+            db.session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS record_fts_ad AFTER DELETE ON record BEGIN "
+                "INSERT INTO record_fts(record_fts, rowid, map, device) VALUES ('delete', old.id, old.map, old.device); END"
+            ))
+            db.session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS record_fts_au AFTER UPDATE OF map, device ON record BEGIN "
+                "INSERT INTO record_fts(record_fts, rowid, map, device) VALUES ('delete', old.id, old.map, old.device); "
+                "INSERT INTO record_fts(rowid, map, device) VALUES (new.id, new.map, new.device); END"
+            ))
+            db.session.commit()
+    except Exception:
+        # sem permissão para a extensão / SQLite sem FTS5 trigram
+        db.session.rollback()
+        raise
+
+
+def migrate_map_search_index():
+    # autocomplete de mapas sem diferenciar maiúsculas (ver map_search_key)
+    key = 'lower(name) COLLATE "C"' if db.engine.dialect.name == "postgresql" else "lower(name)"
+    db.session.execute(text(
+        f'CREATE INDEX IF NOT EXISTS ix_company_map_company_lname ON "company_map" (company, ({key}))'
+    ))
+    db.session.commit()
+
+
+def migrate_admin_user():
     # garante usuário padrão
     if not User.query.filter_by(username="admin").first():
         db.session.add(User(username="admin", password="admin", is_admin=True, splicer_name="ADMIN"))
         db.session.commit()
 
-    # migração simples de colunas (funciona tanto em SQLite quanto em Postgres)
-    def ensure(table, col, typ):
-        """Garante que uma coluna exista na tabela informada."""
-        inspector = inspect(db.engine)
-        existing = [c["name"] for c in inspector.get_columns(table)]
-        if col not in existing:
-            # Em Postgres, usar aspas duplas no nome da tabela evita problemas de case
-            db.session.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {col} {typ}'))
+
+def migrate_rollup():
+    # rollup criado agora em um banco que já tem lançamentos: popula uma vez
+    if not RecordDailyRollup.query.first() and Record.query.first():
+        rebuild_rollup()
+
+
+def migrate_rollup_unique_key():
+    # uma linha por chave (upsert em rollup_apply_many): junta as repetidas antes dos índices únicos
+    R = RecordDailyRollup
+    key = (R.day, R.company, R.splicer, R.map, R.device)
+    if db.session.query(*key).group_by(*key).having(func.count() > 1).first():
+        rebuild_rollup()
+    _ensure_index("ux_rollup_key", "record_daily_rollup", ("day", "company", "splicer", "map", "device"), unique=True)
+    db.session.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_rollup_undated_key ON "record_daily_rollup" '
+        "(company, splicer, map, device) WHERE day IS NULL"
+    ))
+    db.session.execute(text("DROP INDEX IF EXISTS ix_rollup_key"))
+    db.session.commit()
+
+
+def migrate_export_job_heartbeat():
+    _ensure_column("export_job", "dispatched_at", "TIMESTAMP")
+
+
+def migrate_drop_map_device_index():
+    # duplicidade é checada pelo ux_record_fingerprint; (map, device, company) não tem mais consulta
+    db.session.execute(text("DROP INDEX IF EXISTS ix_record_map_device_company"))
+    db.session.commit()
+
+
+# passos em ordem; cada um é idempotente (bancos antigos, sem schema_version, passam por todos)
+MIGRATIONS = (
+    (1, migrate_tables),
+    (2, migrate_legacy_columns),
+    (3, migrate_indexes),
+    (4, migrate_search_index),
+    (5, migrate_admin_user),
+    (6, migrate_rollup),
+    (7, migrate_map_search_index),
+    (8, migrate_rollup_unique_key),
+    (9, migrate_export_job_heartbeat),
+    (10, migrate_drop_map_device_index),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_KEY = 0x5011CE  # pg_advisory_lock
+
+
+def schema_version() -> int:
+    """Última migração aplicada (0 se o banco ainda não tem a tabela)."""
+    try:
+        return int(db.session.execute(select(func.max(SchemaVersion.version))).scalar() or 0)
+    except Exception:
+        db.session.rollback()
+        return 0
+
+
+@contextmanager
+def migration_lock():
+    """Um processo por vez aplica migrações (advisory lock no Postgres, flock nos demais)."""
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        return
+
+    import fcntl  # só Unix; SQLite de desenvolvimento
+
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    with open(os.path.join(current_app.instance_path, "migrate.lock"), "w") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def migrate_schema() -> list[int]:
+    """Aplica as migrações pendentes sob o lock; retorna as versões aplicadas."""
+    # migração disparada por um request (AUTO_MIGRATE) também roda sem statement_timeout:
+    # fecha a transação já aberta com o limite e as próximas começam sem ele
+    g.migrating = True
+    db.session.commit()
+    try:
+        applied = _apply_migrations()
+    finally:
+        g.pop("migrating", None)
+    if applied:
+        # a busca por trecho pode ter ganho índice/tabela FTS agora
+        app_cache().pop("search_backend", None)
+    return applied
+
+
+def _apply_migrations() -> list[int]:
+    applied = []
+    with migration_lock():
+        # outro worker pode ter migrado enquanto esperávamos o lock
+        current = schema_version()
+        for version, step in MIGRATIONS:
+            if version <= current:
+                continue
+            step()
+            db.session.add(SchemaVersion(version=version))
             db.session.commit()
+            applied.append(version)
+    return applied
+
+
+_schema_lock = threading.Lock()
+
+
+def ensure_schema():
+    """Checa o schema uma vez por processo (e app), no primeiro uso; migra se AUTO_MIGRATE."""
+    cache = app_cache()
+    if cache.get("schema_checked"):
+        return
+    with _schema_lock:
+        if cache.get("schema_checked"):
+            return
+        # schema em dia custa um SELECT max() na chave primária de schema_version
+        if schema_version() < SCHEMA_VERSION:
+            if current_app.config["AUTO_MIGRATE"]:
+                migrate_schema()
+            else:
+                current_app.logger.warning("schema desatualizado: rode `flask --app app migrate`")
+        cache["schema_checked"] = True
+
+
+@bp.before_app_request
+def ensure_schema_before_request():
+    ensure_schema()
 
-    ensure("record", "company", "VARCHAR(120)")
-    ensure("device_type", "company", "VARCHAR(120)")
-    ensure("splice_tier", "company", "VARCHAR(120)")
-    ensure("company_config", "invoice_address", "TEXT")
-    ensure("user", "is_admin", "BOOLEAN")
-    ensure("user", "splicer_name", "VARCHAR(120)")
 
 # --------- Login ---------
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     if request.method == "POST":
         username = (request.form.get("username") or "").strip()
@@ -148,186 +982,1303 @@ def login():
             login_user(user)
             flash("Login realizado com sucesso.", "success")
             next_page = request.args.get("next")
-            return redirect(next_page or url_for("index"))
+            return redirect(next_page or url_for("main.index"))
 
         flash("Usuário ou senha inválidos.", "danger")
 
     return render_template("login.html")
 
 # --------- Helpers de preço ---------
+class PricingSnapshot:
+    """Tabelas de preço (CompanyConfig, SpliceTier, DeviceType) carregadas em memória.
+
+    Reproduz as mesmas regras das antigas consultas: valor da empresa tem
+    prioridade sobre o global (company = None) e, nas faixas, vale a de maior
+    min_splices que contenha a quantidade.
+    """
+
+    def __init__(self, version: int = 0):
+        self.version = version
+        self.included = {
+            c.name: int(c.included_splices or 0) for c in CompanyConfig.query.all()
+        }
+
+        # (empresa, nome em minúsculas) -> valor; empresa None = valor padrão
+        self.devices = {}
+        # nome em minúsculas -> valor, para lançamentos sem empresa
+        self.devices_any = {}
+        for dt in DeviceType.query.order_by(DeviceType.id).all():
+            key = (dt.name or "").lower()
+            self.devices.setdefault((dt.company, key), float(dt.value_usd or 0.0))
+            self.devices_any.setdefault(key, float(dt.value_usd or 0.0))
+
+        # empresa -> faixas ordenadas por min_splices (None = faixas globais)
+        by_company = {}
+        all_tiers = []
+        for t in SpliceTier.query.order_by(SpliceTier.id).all():
+            tier = (int(t.min_splices), t.max_splices, float(t.price_per_splice_usd or 0.0))
+            by_company.setdefault(t.company, []).append(tier)
+            all_tiers.append(tier)
+        self.tiers = {
+            company: self._sorted(tiers) for company, tiers in by_company.items()
+        }
+        self.tiers_any = self._sorted(all_tiers)
+
+    @staticmethod
+    def _sorted(tiers):
+        # estável: em empates de min_splices a faixa cadastrada antes fica por último
+        tiers = sorted(reversed(tiers), key=lambda t: t[0])
+        return [t[0] for t in tiers], tiers
+
+    @staticmethod
+    def _lookup(table, count: int):
+        if not table:
+            return None
+        mins, tiers = table
+        i = bisect_right(mins, count)
+        while i > 0:
+            i -= 1
+            _min, max_s, price = tiers[i]
+            if max_s is None or max_s >= count:
+                return price
+        return None
+
+    def included_splices(self, company: str | None) -> int:
+        if not company:
+            return 1  # padrão antigo: 1 fusão inclusa
+        return self.included.get(company, 1)
+
+    def device_value(self, name: str, company: str | None) -> float:
+        if not name:
+            return 0.0
+        key = name.lower()
+        if company:
+            value = self.devices.get((company, key))
+            if value is None:
+                value = self.devices.get((None, key))
+        else:
+            value = self.devices_any.get(key)
+        return value if value is not None else 0.0
+
+    def tier_price(self, count: int, company: str | None) -> float:
+        if company:
+            price = self._lookup(self.tiers.get(company), count)
+            if price is None:
+                price = self._lookup(self.tiers.get(None), count)
+        else:
+            price = self._lookup(self.tiers_any, count)
+        return price if price is not None else 0.0
+
+    def compute(self, splices: int, device_name: str, company: str | None):
+        included = self.included_splices(company)
+        charge = max(int(splices or 0) - included, 0)
+        price_splices = charge * self.tier_price(charge, company)
+        price_device = self.device_value(device_name or "", company)
+        return price_splices, price_device, price_splices + price_device
+
+
+_pricing_lock = threading.Lock()
+
+
+def get_pricing() -> PricingSnapshot:
+    """Snapshot de preços do worker; recarrega só quando a versão "pricing" muda."""
+    cache = app_cache()
+    version = current_version("pricing")
+    snap = cache.get("pricing")
+    if snap is None or snap.version != version:
+        with _pricing_lock:
+            snap = cache.get("pricing")
+            if snap is None or snap.version != version:
+                snap = PricingSnapshot(version)
+                cache["pricing"] = snap
+    return snap
+
+
+# --------- Listas de empresas / splicers (filtros) ---------
+class DimensionCache:
+    """Empresas e splicers conhecidos, para os dropdowns de filtro.
+
+    Lidos do rollup (bem menor que record), de CompanyConfig e de User, e
+    guardados por worker até a versão "dimensions" mudar ou o TTL vencer.
+    """
+
+    def __init__(self, version: int = 0):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        R = RecordDailyRollup
+        companies = {c for (c,) in db.session.query(CompanyConfig.name)}
+        # só nomes que ainda têm lançamentos (exclusões deixam linhas zeradas no rollup)
+        companies |= {c for (c,) in db.session.query(R.company).group_by(R.company).having(func.sum(R.record_count) > 0) if c}
+        splicers = {s for (s,) in db.session.query(R.splicer).group_by(R.splicer).having(func.sum(R.record_count) > 0) if s}
+        splicers |= {
+            (splicer_name or username)
+            for splicer_name, username in db.session.query(User.splicer_name, User.username)
+            if (splicer_name or username)
+        }
+        self.companies = sorted(companies)
+        self.splicers = sorted(splicers)
+        self._company_set = set(self.companies)
+        self._splicer_set = set(self.splicers)
+
+    def knows(self, company: str | None, splicer: str | None) -> bool:
+        return (not company or company in self._company_set) and (not splicer or splicer in self._splicer_set)
+
+
+_dimension_lock = threading.Lock()
+
+
+def get_dimensions() -> DimensionCache:
+    caches = app_cache()
+    version = current_version("dimensions")
+    cache = caches.get("dimensions")
+    ttl = current_app.config["DIMENSION_CACHE_TTL"]
+    if cache is None or cache.version != version or time.monotonic() - cache.loaded_at > ttl:
+        with _dimension_lock:
+            cache = caches.get("dimensions")
+            if cache is None or cache.version != version or time.monotonic() - cache.loaded_at > ttl:
+                cache = DimensionCache(version)
+                caches["dimensions"] = cache
+    return cache
+
+
+# --------- Dados do formulário de lançamento ---------
+class FormLookups:
+    """Empresas e dispositivos usados no formulário de lançamento.
+
+    Montado uma vez por worker para cada versão "lookups" e já serializado em
+    JSON, servido por /api/lookups com ETag e cache no navegador.
+    """
+
+    def __init__(self, version: int = 0):
+        self.version = version
+        self.companies = [name for (name,) in db.session.query(CompanyConfig.name).order_by(CompanyConfig.name)]
+
+        # dispositivos cadastrados por empresa
+        devices_by_company = {}
+        for company, name in db.session.query(DeviceType.company, DeviceType.name).order_by(DeviceType.company, DeviceType.name):
+            devices_by_company.setdefault(company or "__global__", []).append(name)
+
+        self.body = json.dumps({
+            "version": version,
+            "companies": self.companies,
+            "devices_by_company": devices_by_company,
+        })
+        self.etag = f"lookups-{version}"
+
+
+_lookups_lock = threading.Lock()
+
+
+def get_lookups() -> FormLookups:
+    caches = app_cache()
+    version = current_version("lookups")
+    cache = caches.get("lookups")
+    if cache is None or cache.version != version:
+        with _lookups_lock:
+            cache = caches.get("lookups")
+            if cache is None or cache.version != version:
+                cache = FormLookups(version)
+                caches["lookups"] = cache
+    return cache
+
+
+MAP_SEARCH_LIMIT = 20
+MAP_SEARCH_MAX_LIMIT = 100
+
+
+def search_maps(version: int, company: str, prefix: str, limit: int = MAP_SEARCH_LIMIT) -> tuple:
+    """Mapas da empresa que começam com `prefix`, pelo LRU do app (ver query_maps).
+
+    A versão "lookups" faz parte da chave do LRU: mudou um mapa, as entradas
+    antigas simplesmente deixam de ser usadas.
+    """
+    return app_cache()["search_maps"](version, company, prefix.lower(), limit)
+
+
+def map_search_key():
+    """lower(name) em ordem de code point: COLLATE "C" no Postgres, BINARY (padrão) no SQLite."""
+    key = func.lower(CompanyMap.name)
+    if db.engine.dialect.name == "postgresql":
+        key = key.collate("C")
+    return key
+
+
+def query_maps(version: int, company: str, prefix: str, limit: int = MAP_SEARCH_LIMIT) -> tuple:
+    """Mapas da empresa que começam com `prefix`, sem diferenciar maiúsculas (autocomplete).
+
+    Faixa [prefix, prefix com o último caractere + 1) sobre lower(name), que usa
+    o índice de expressão ix_company_map_company_lname. Com a ordem por code
+    point a faixa não depende da collation do banco. O SQLite só converte
+    letras ASCII no lower().
+    """
+    key = map_search_key()
+    query = db.session.query(CompanyMap.name).filter(CompanyMap.company == company)
+    prefix = prefix.lower()
+    if prefix:
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        query = query.filter(key >= prefix, key < upper)
+    return tuple(name for (name,) in query.order_by(key, CompanyMap.name).limit(limit))
+
+
 def included_splices_for(company: str | None) -> int:
     """Quantas fusões são inclusas para essa empresa."""
-    if not company:
-        return 1  # padrão antigo: 1 fusão inclusa
-    cfg = CompanyConfig.query.filter_by(name=company).first()
-    if cfg:
-        return int(cfg.included_splices or 0)
-    return 1
+    return get_pricing().included_splices(company)
 
 def device_value_for(name: str, company: str | None) -> float:
-    if not name:
-        return 0.0
-    q = DeviceType.query.filter(DeviceType.name.ilike(name))
-    if company:
-        q = q.filter(or_(DeviceType.company == company, DeviceType.company.is_(None)))
-        dt = q.order_by(case((DeviceType.company == company, 0), else_=1)).first()
-    else:
-        dt = q.first()
-    return float(dt.value_usd) if dt else 0.0
+    return get_pricing().device_value(name, company)
 
 def tier_price_for(count: int, company: str | None) -> float:
-    from sqlalchemy import or_ as _or, case as _case
-    q = SpliceTier.query.filter(SpliceTier.min_splices <= count)
+    return get_pricing().tier_price(count, company)
+
+
+def compute_prices(splices: int, device_name: str, company: str | None, pricing: PricingSnapshot | None = None):
+    """Calcula preço de fusões e dispositivo para um lançamento manual."""
+    return (pricing or get_pricing()).compute(splices, device_name, company)
+
+
+# --------- Busca por trecho (map / device) ---------
+record_fts = table("record_fts", column("rowid"), column("map"), column("device"))
+
+
+def search_backend() -> str:
+    """Backend da busca por trecho ("trgm", "fts5" ou "like"), detectado uma vez por worker."""
+    cache = app_cache()
+    if "search_backend" not in cache:
+        dialect = db.engine.dialect.name
+        found = None
+        if dialect == "postgresql":
+            found = db.session.execute(text(
+                "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_record_map_trgm'"
+            )).first()
+        elif dialect == "sqlite":
+            found = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'record_fts'"
+            )).first()
+        cache["search_backend"] = {"postgresql": "trgm", "sqlite": "fts5"}.get(dialect) if found else "like"
+    return cache["search_backend"]
+
+
+def contains_filter(col_name: str, value: str):
+    """Predicado "contém" (sem diferenciar maiúsculas) em Record.map ou Record.device."""
+    pattern = f"%{value}%"
+    if search_backend() == "fts5":
+        return Record.id.in_(
+            select(record_fts.c.rowid).where(record_fts.c[col_name].like(pattern))
+        )
+    # Postgres com pg_trgm usa o índice GIN direto no ILIKE
+    return getattr(Record, col_name).ilike(pattern)
+
+
+# --------- Filtros de lançamentos ---------
+def _parse_iso(raw: str | None):
+    if not raw:
+        return None
+    try:
+        return datetime.fromisoformat(raw)
+    except ValueError:
+        return None
+
+
+class RecordFilter:
+    """Filtros da tela principal e dos exports (empresa, splicer, map, dispositivo, período).
+
+    Lidos uma vez da querystring e transformados em um predicado SQLAlchemy
+    reutilizável. Usuário comum fica sempre restrito aos próprios lançamentos
+    (``enforced_splicer``); só o admin filtra por outro splicer.
+    """
+
+    def __init__(self, company=None, splicer=None, map=None, device=None, start=None, end=None, enforced_splicer=None):
+        self.company = company or None
+        self.splicer = splicer or None
+        self.map = map or None
+        self.device = device or None
+        # texto como veio, para devolver ao formulário
+        self.start = start or None
+        self.end = end or None
+        self.start_dt = _parse_iso(self.start)
+        self.end_dt = _parse_iso(self.end)
+        self.enforced_splicer = enforced_splicer or None
+
+    @classmethod
+    def from_args(cls, args, user) -> "RecordFilter":
+        is_admin = getattr(user, "is_admin", False)
+        enforced = None if is_admin else (getattr(user, "splicer_name", None) or user.username)
+        return cls(
+            company=args.get("company"),
+            splicer=args.get("splicer") if is_admin else None,
+            map=args.get("map"),
+            device=args.get("device"),
+            start=args.get("start"),
+            end=args.get("end"),
+            enforced_splicer=enforced,
+        )
+
+    def scope_predicates(self) -> list:
+        """Só empresa e splicer (sem período nem busca por texto)."""
+        preds = []
+        if self.company:
+            preds.append(Record.company == self.company)
+        if self.splicer:
+            preds.append(Record.splicer == self.splicer)
+        if self.enforced_splicer:
+            preds.append(Record.splicer == self.enforced_splicer)
+        return preds
+
+    def predicates(self) -> list:
+        preds = self.scope_predicates()
+        if self.map:
+            preds.append(contains_filter("map", self.map))
+        if self.device:
+            preds.append(contains_filter("device", self.device))
+        if self.start_dt:
+            preds.append(Record.created_date >= self.start_dt)
+        if self.end_dt:
+            preds.append(Record.created_date <= self.end_dt)
+        return preds
+
+    def apply(self, query):
+        return query.filter(*self.predicates())
+
+    def query(self):
+        return self.apply(Record.query)
+
+    def to_args(self) -> dict:
+        """Filtros preenchidos, no formato da querystring (links, jobs de export)."""
+        values = {
+            "company": self.company,
+            "splicer": self.splicer,
+            "map": self.map,
+            "device": self.device,
+            "start": self.start,
+            "end": self.end,
+        }
+        return {k: v for k, v in values.items() if v}
+
+
+# --------- Reprecificação em lote ---------
+def reprice_records(company: str | None, start_dt=None, end_dt=None, chunk_size: int = 2000, dry_run: bool = False,
+                    progress=None) -> dict:
+    """Recalcula price_*_usd/total_usd dos lançamentos com a tabela de preços atual.
+
+    Percorre os registros em blocos por id (keyset), carregando só as colunas
+    usadas no cálculo, e grava cada bloco com um UPDATE em lote e commit
+    próprio, então a memória e o tamanho das transações ficam limitados
+    mesmo com milhões de linhas. A diferença de valores vai para o rollup no
+    mesmo commit do bloco: se o processo parar no meio, os dois continuam batendo.
+    """
+    pricing = get_pricing()
+    started = time.perf_counter()
+    report = {"rows": 0, "changed": 0, "total_before": 0.0, "total_after": 0.0}
+
+    base = db.session.query(
+        Record.id, Record.splices, Record.type, Record.device, Record.company,
+        Record.price_splices_usd, Record.price_device_usd, Record.total_usd,
+        Record.created_date, Record.splicer, Record.map,
+    )
     if company:
-        q = q.filter(_or(SpliceTier.company == company, SpliceTier.company.is_(None)))
-        q = q.filter(_or(SpliceTier.max_splices == None, SpliceTier.max_splices >= count))
-        tier = q.order_by(
-            _case((SpliceTier.company == company, 0), else_=1),
-            SpliceTier.min_splices.desc()
-        ).first()
+        base = base.filter(Record.company == company)
+    if start_dt:
+        base = base.filter(Record.created_date >= start_dt)
+    if end_dt:
+        base = base.filter(Record.created_date <= end_dt)
+
+    total_rows = base.order_by(None).count() if progress else 0
+    last_id = 0
+    while True:
+        chunk = base.filter(Record.id > last_id).order_by(Record.id).limit(chunk_size).all()
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+
+        # preço calculado uma vez por combinação distinta no bloco
+        prices = {}
+        for key in {(r.splices or 0, r.type or r.device or "", r.company) for r in chunk}:
+            prices[key] = pricing.compute(*key)
+
+        updates = []
+        rollup_deltas = {}
+        for r in chunk:
+            price_splices, price_device, total = prices[(r.splices or 0, r.type or r.device or "", r.company)]
+            report["total_before"] += float(r.total_usd or 0.0)
+            report["total_after"] += total
+            if (r.price_splices_usd, r.price_device_usd, r.total_usd) != (price_splices, price_device, total):
+                updates.append({
+                    "id": r.id,
+                    "price_splices_usd": price_splices,
+                    "price_device_usd": price_device,
+                    "total_usd": total,
+                })
+                deltas = rollup_deltas.setdefault(rollup_key(r), {"total_usd": 0.0, "price_device_usd": 0.0})
+                deltas["total_usd"] += total - float(r.total_usd or 0.0)
+                deltas["price_device_usd"] += price_device - float(r.price_device_usd or 0.0)
+        report["rows"] += len(chunk)
+        report["changed"] += len(updates)
+
+        if updates and not dry_run:
+            db.session.bulk_update_mappings(Record, updates)
+            rollup_add(rollup_deltas)
+            db.session.commit()
+        if progress:
+            progress(min(report["rows"] / total_rows, 1.0) if total_rows else 1.0)
+
+    elapsed = time.perf_counter() - started
+    report["seconds"] = elapsed
+    report["rows_per_sec"] = report["rows"] / elapsed if elapsed > 0 else 0.0
+    report["delta"] = report["total_after"] - report["total_before"]
+    return report
+
+
+# --------- Agrupamentos (GROUP BY) ---------
+def rollup_split(filt):
+    """Divide o filtro entre o rollup (dias inteiros) e janelas de Record (dias de borda).
+
+    Retorna (predicados do rollup ou None, janelas antes, janelas depois), onde
+    cada janela é uma lista de predicados sobre Record. Busca por map/dispositivo
+    não usa o rollup; aí tudo vai em uma única janela crua. As janelas "antes"
+    cobrem dias anteriores aos do rollup e as "depois", dias posteriores.
+    """
+    if filt.map or filt.device:
+        return None, [filt.predicates()], []
+
+    R = RecordDailyRollup
+    scope = filt.scope_predicates()
+    rollup_preds = []
+    if filt.company:
+        rollup_preds.append(R.company == filt.company)
+    if filt.splicer:
+        rollup_preds.append(R.splicer == filt.splicer)
+    if filt.enforced_splicer:
+        rollup_preds.append(R.splicer == filt.enforced_splicer)
+
+    start_dt, end_dt = filt.start_dt, filt.end_dt
+    if not start_dt and not end_dt:
+        return rollup_preds, [], []
+
+    rollup_preds.append(R.day.isnot(None))
+    head, tail = [], []
+    first_full = last_full = None
+    if start_dt:
+        first_full = start_dt.date()
+        if start_dt.time() != datetime.min.time():
+            # início no meio do dia: o resto desse dia vem de Record
+            next_midnight = datetime.combine(start_dt.date() + timedelta(days=1), datetime.min.time())
+            if end_dt and end_dt < next_midnight:
+                return None, [filt.predicates()], []
+            head.append(scope + [Record.created_date >= start_dt, Record.created_date < next_midnight])
+            first_full = start_dt.date() + timedelta(days=1)
+    if end_dt:
+        # "até end_dt" pega só parte do último dia, que vem de Record
+        end_midnight = datetime.combine(end_dt.date(), datetime.min.time())
+        lo = max(end_midnight, start_dt) if start_dt else end_midnight
+        tail.append(scope + [Record.created_date >= lo, Record.created_date <= end_dt])
+        last_full = end_dt.date() - timedelta(days=1)
+
+    if first_full:
+        rollup_preds.append(R.day >= first_full)
+    if last_full:
+        rollup_preds.append(R.day <= last_full)
+    if first_full and last_full and first_full > last_full:
+        rollup_preds = None
+    return rollup_preds, head, tail
+
+
+def filter_totals(filt) -> dict:
+    """Totais do filtro (linhas, USD, fusões, HUBs), pelo rollup quando possível."""
+    R = RecordDailyRollup
+    rollup_preds, head, tail = rollup_split(filt)
+    totals = {"rows": 0, "amount": 0.0, "splices": 0, "hubs": 0}
+    if rollup_preds is not None:
+        row = db.session.query(
+            func.coalesce(func.sum(R.record_count), 0),
+            func.coalesce(func.sum(R.total_usd), 0.0),
+            func.coalesce(func.sum(R.splices), 0),
+            func.coalesce(func.sum(R.hub_count), 0),
+        ).filter(*rollup_preds).one()
+        totals = {"rows": int(row[0]), "amount": float(row[1]), "splices": int(row[2]), "hubs": int(row[3])}
+    for preds in head + tail:
+        part = record_totals(Record.query.filter(*preds))
+        for k in totals:
+            totals[k] += part[k]
+    return totals
+
+
+def invoice_lines(filt) -> list:
+    """Linhas da invoice somadas por mapa + dispositivo direto no banco (rollup + bordas)."""
+    R = RecordDailyRollup
+    rollup_preds, head, tail = rollup_split(filt)
+    sources = []
+    if rollup_preds is not None:
+        sources.append(
+            db.session.query(
+                R.map.label("map"),
+                R.device.label("device"),
+                func.sum(R.splices).label("splices"),
+                func.sum(R.total_usd).label("total_usd"),
+                func.sum(R.price_device_usd).label("price_device_usd"),
+                func.sum(R.record_count).label("records"),
+            ).filter(*rollup_preds).group_by(R.map, R.device).having(func.sum(R.record_count) > 0)
+        )
+    map_k = _trimmed(Record.map)
+    device_k = _trimmed(Record.device)
+    for preds in head + tail:
+        sources.append(
+            db.session.query(
+                map_k.label("map"),
+                device_k.label("device"),
+                func.coalesce(func.sum(Record.splices), 0).label("splices"),
+                func.coalesce(func.sum(Record.total_usd), 0.0).label("total_usd"),
+                func.coalesce(func.sum(Record.price_device_usd), 0.0).label("price_device_usd"),
+                func.count(Record.id).label("records"),
+            ).filter(*preds).group_by(map_k, device_k)
+        )
+
+    grouped = {}
+    for q in sources:
+        for g in q.yield_per(500):
+            acc = grouped.setdefault((g.map or "", g.device or ""), [0, 0.0, 0.0, 0])
+            acc[0] += int(g.splices or 0)
+            acc[1] += float(g.total_usd or 0.0)
+            acc[2] += float(g.price_device_usd or 0.0)
+            acc[3] += int(g.records or 0)
+
+    lines = []
+    for (map_name, device_name), (splices, total, price_device_sum, records) in sorted(grouped.items()):
+        # preço médio do dispositivo no grupo; se vier zero mas houver total,
+        # usa um valor médio por fusão
+        price_device = price_device_sum / records if records else 0.0
+        if price_device == 0.0 and total and splices:
+            price_device = total / splices
+        lines.append({
+            "map": map_name or "-",
+            "device": device_name or "-",
+            "splices": splices,
+            "price_device_usd": price_device,
+            "total_usd": total,
+        })
+    return lines
+
+
+def excel_daily_lines(filt):
+    """Gera [data, mapa, dispositivo, fusões] somados por dia, em ordem de data, lendo em blocos."""
+    R = RecordDailyRollup
+    rollup_preds, head, tail = rollup_split(filt)
+    map_k = _trimmed(Record.map)
+    device_k = _trimmed(Record.device)
+    day_k = _day(Record.created_date)
+
+    def raw(preds):
+        return (
+            db.session.query(
+                day_k.label("day"),
+                map_k.label("map"),
+                device_k.label("device"),
+                func.coalesce(func.sum(Record.splices), 0).label("splices"),
+            )
+            .filter(*preds)
+            .group_by(day_k, map_k, device_k)
+            .order_by(day_k.asc().nullsfirst(), map_k, device_k)
+        )
+
+    sources = [raw(preds) for preds in head]
+    if rollup_preds is not None:
+        sources.append(
+            db.session.query(
+                R.day.label("day"),
+                R.map.label("map"),
+                R.device.label("device"),
+                func.sum(R.splices).label("splices"),
+            )
+            .filter(*rollup_preds)
+            .group_by(R.day, R.map, R.device)
+            .having(func.sum(R.record_count) > 0)
+            .order_by(R.day.asc().nullsfirst(), R.map, R.device)
+        )
+    sources += [raw(preds) for preds in tail]
+
+    for q in sources:
+        for g in q.yield_per(1000):
+            yield [str(g.day) if g.day else "", g.map or "-", g.device or "-", int(g.splices or 0)]
+
+
+def excel_stats(filt) -> dict:
+    """Totais e tamanhos máximos de texto do export Excel (rollup + bordas)."""
+    R = RecordDailyRollup
+    rollup_preds, head, tail = rollup_split(filt)
+    device_k = _trimmed(Record.device)
+    stats = {"rows": 0, "splices": 0, "map_len": 0, "device_len": 0}
+    device_sources = []
+    parts = []
+    if rollup_preds is not None:
+        parts.append(db.session.query(
+            func.sum(R.record_count),
+            func.sum(R.splices),
+            func.max(func.length(R.map)),
+            func.max(func.length(R.device)),
+        ).filter(*rollup_preds))
+        # chaves que ficaram sem lançamentos continuam no rollup com contagem zero
+        device_sources.append(
+            select(R.device.label("device")).where(*rollup_preds, R.device != "")
+            .group_by(R.device).having(func.sum(R.record_count) > 0)
+        )
+    for preds in head + tail:
+        parts.append(db.session.query(
+            func.count(Record.id),
+            func.sum(Record.splices),
+            func.max(func.length(_trimmed(Record.map))),
+            func.max(func.length(device_k)),
+        ).filter(*preds))
+        device_sources.append(select(device_k.label("device")).where(*preds, device_k != literal_column("''")))
+
+    for q in parts:
+        row = q.one()
+        stats["rows"] += int(row[0] or 0)
+        stats["splices"] += int(row[1] or 0)
+        stats["map_len"] = max(stats["map_len"], int(row[2] or 0))
+        stats["device_len"] = max(stats["device_len"], int(row[3] or 0))
+
+    # dispositivos distintos entre todas as partes (UNION já remove repetidos)
+    devices = union(*device_sources).subquery() if len(device_sources) > 1 else device_sources[0].distinct().subquery()
+    stats["devices"] = int(db.session.execute(select(func.count()).select_from(devices)).scalar() or 0)
+    return stats
+
+
+# --------- Export XLSX ---------
+def write_xlsx(out, title: str, headers, rows, footer, widths):
+    """Gera um XLSX em modo write-only no arquivo ``out``.
+
+    As linhas vão direto para disco conforme são escritas (``rows`` pode ser um
+    gerador) e os estilos são NamedStyles compartilhados, então a memória não
+    cresce com o número de linhas. ``widths`` precisa vir pronto porque o
+    openpyxl grava as larguras no início da planilha.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Border, Side, NamedStyle
+    from openpyxl.utils import get_column_letter
+
+    thin = Side(border_style="thin", color="000000")
+    border = Border(top=thin, left=thin, right=thin, bottom=thin)
+
+    wb = Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(name="xlsx_header", font=Font(bold=True), border=border))
+    wb.add_named_style(NamedStyle(name="xlsx_cell", border=border))
+    wb.add_named_style(NamedStyle(name="xlsx_total", font=Font(bold=True), border=border))
+
+    ws = wb.create_sheet(title)
+    for i, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(i)].width = width + 2
+
+    def styled(values, style):
+        cells = []
+        for val in values:
+            cell = WriteOnlyCell(ws, value=val)
+            cell.style = style
+            cells.append(cell)
+        return cells
+
+    ncols = len(headers)
+    ws.append(styled(headers, "xlsx_header"))
+    for row in rows:
+        ws.append(styled(row, "xlsx_cell"))
+    if footer:
+        ws.append(styled([None] * ncols, "xlsx_cell"))
+        for row in footer:
+            ws.append(styled(row, "xlsx_total"))
+
+    wb.save(out)
+
+
+# --------- Totais ---------
+def record_totals(query) -> dict:
+    """Totais do filtro em um único SELECT agregado (sem carregar os registros)."""
+    row = query.order_by(None).with_entities(
+        func.count(Record.id),
+        func.coalesce(func.sum(Record.total_usd), 0.0),
+        func.coalesce(func.sum(Record.splices), 0),
+        func.coalesce(func.sum(case((func.upper(Record.type) == "HUB", 1), else_=0)), 0),
+    ).one()
+    return {
+        "rows": int(row[0] or 0),
+        "amount": float(row[1] or 0.0),
+        "splices": int(row[2] or 0),
+        "hubs": int(row[3] or 0),
+    }
+
+
+# --------- Paginação (keyset em created_date, id) ---------
+def encode_cursor(rec) -> str:
+    """Cursor opaco para a querystring: "<created_date iso>|<id>" (data vazia = NULL)."""
+    created = rec.created_date.isoformat() if rec.created_date else ""
+    return f"{created}|{rec.id}"
+
+
+def decode_cursor(raw: str | None):
+    """Retorna (created_date, id) ou None se o cursor for inválido."""
+    if not raw or "|" not in raw:
+        return None
+    created_raw, _, id_raw = raw.rpartition("|")
+    try:
+        rid = int(id_raw)
+        created = datetime.fromisoformat(created_raw) if created_raw else None
+    except ValueError:
+        return None
+    return created, rid
+
+
+def paginate_records(query, after=None, before=None, per_page=100):
+    """Paginação keyset na ordem da listagem (created_date desc nulls last, id desc).
+
+    Em vez de OFFSET, filtra a partir do último/primeiro registro da página
+    visível, então o custo de cada página não cresce com a profundidade.
+    Retorna (records, next_cursor, prev_cursor).
+    """
+    if before:
+        created, rid = before
+        if created is None:
+            query = query.filter(or_(
+                Record.created_date.isnot(None),
+                Record.id > rid,
+            ))
+        else:
+            query = query.filter(or_(
+                Record.created_date > created,
+                and_(Record.created_date == created, Record.id > rid),
+            ))
+        rows = query.order_by(
+            Record.created_date.asc().nullsfirst(), Record.id.asc()
+        ).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        records = list(reversed(rows[:per_page]))
+        has_next, has_prev = True, has_more
     else:
-        q = q.filter(_or(SpliceTier.max_splices == None, SpliceTier.max_splices >= count))
-        tier = q.order_by(SpliceTier.min_splices.desc()).first()
-    return float(tier.price_per_splice_usd) if tier else 0.0
+        if after:
+            created, rid = after
+            if created is None:
+                query = query.filter(Record.created_date.is_(None), Record.id < rid)
+            else:
+                query = query.filter(or_(
+                    Record.created_date < created,
+                    and_(Record.created_date == created, Record.id < rid),
+                    Record.created_date.is_(None),
+                ))
+        rows = query.order_by(
+            Record.created_date.desc().nullslast(), Record.id.desc()
+        ).limit(per_page + 1).all()
+        records = rows[:per_page]
+        has_next, has_prev = len(rows) > per_page, bool(after)
+
+    next_cursor = encode_cursor(records[-1]) if records and has_next else None
+    prev_cursor = encode_cursor(records[0]) if records and has_prev else None
+    return records, next_cursor, prev_cursor
+
+
+# --------- Lançamento em lote ---------
+BATCH_ENTRY_MAX_ROWS = 500
+ENTRY_MAP_REQUIRED = "Map é obrigatório."
+BATCH_ENTRY_FIELDS = ("company", "map", "type", "device_name", "splices", "created", "splicer")
+
+
+def parse_entry_row(raw: dict, default_splicer: str):
+    """Valida uma linha do lançamento em lote; retorna (valores de Record, erro)."""
+    def field(name):
+        value = raw.get(name)
+        return "" if value is None else str(value).strip()
+
+    company = field("company") or None
+    map_val = field("map")
+    type_val = field("type")
+    device_name = field("device_name") or field("device")
+    # mesma regra do lançamento individual: map obrigatório, empresa opcional (preço global)
+    if not map_val:
+        return None, ENTRY_MAP_REQUIRED
 
+    try:
+        splices = int(field("splices") or 0)
+    except ValueError:
+        return None, "Splices inválido."
 
-def compute_prices(splices: int, device_name: str, company: str | None):
-    """Calcula preço de fusões e dispositivo para um lançamento manual."""
-    included = included_splices_for(company)
-    charge = max(int(splices or 0) - included, 0)
-    price_splices = charge * tier_price_for(charge, company)
-    price_device = device_value_for(device_name or "", company)
-    return price_splices, price_device, price_splices + price_device
+    created_raw = field("created")
+    if created_raw:
+        try:
+            created_date = datetime.strptime(created_raw[:10], "%Y-%m-%d")
+        except ValueError:
+            return None, "Data inválida (use AAAA-MM-DD)."
+    else:
+        today = date.today()
+        created_date = datetime(today.year, today.month, today.day)
+
+    return {
+        "company": company,
+        "map": map_val,
+        "type": type_val,
+        "device": device_name,
+        "splices": splices,
+        "splicer": field("splicer") or default_splicer,
+        "created_date": created_date,
+        "fingerprint": record_fingerprint(company, map_val, device_name),
+    }, None
+
+
+def save_entry_batch(rows: list[dict], default_splicer: str, confirm_duplicates: bool = False) -> list[dict]:
+    """Grava várias linhas de lançamento numa única transação.
+
+    Preço de todas as linhas com um só snapshot, checagem de duplicidade numa
+    consulta IN e INSERT em lote. Retorna um resultado por linha, na mesma
+    ordem: status "saved", "duplicate" (não gravada, falta confirmar),
+    "error" ou "empty" (linha em branco do grid).
+    """
+    results = [{"row": i, "status": "empty"} for i in range(len(rows))]
+    parsed = []
+    for i, raw in enumerate(rows):
+        if not any(str(raw.get(f) or "").strip() for f in ("map", "device_name", "device", "type")):
+            continue
+        values, error = parse_entry_row(raw, default_splicer)
+        if error:
+            results[i].update(status="error", message=error)
+        else:
+            parsed.append((i, values))
+
+    # duplicidade: mesmo fingerprint (empresa + map + dispositivo), numa consulta só
+    fps = {v["fingerprint"] for _, v in parsed if v["fingerprint"]}
+    seen = {}
+    if fps:
+        dup_rows = db.session.query(Record.fingerprint, Record.created_date, Record.splicer).filter(
+            Record.fingerprint.in_(fps)
+        )
+        seen = {fp: (created, splicer) for fp, created, splicer in dup_rows}
+
+    pricing = get_pricing()
+    to_insert = []
+    for i, values in parsed:
+        existing = seen.get(values["fingerprint"]) if values["fingerprint"] else None
+        if existing and not confirm_duplicates:
+            created, splicer = existing
+            results[i].update(
+                status="duplicate",
+                message="Este dispositivo já foi lançado neste map. Data: "
+                + (created.date().isoformat() if created else "-")
+                + f", Splicer: {splicer}.",
+            )
+            continue
+        if existing:
+            results[i]["warning"] = "Dispositivo já lançado neste map (confirmado)."
+
+        price_splices, price_device, total = compute_prices(
+            values["splices"], values["type"] or values["device"], values["company"], pricing
+        )
+        values.update(price_splices_usd=price_splices, price_device_usd=price_device, total_usd=total)
+        to_insert.append((i, values))
+        # linhas repetidas dentro do próprio lote também contam como duplicadas
+        if values["fingerprint"]:
+            seen.setdefault(values["fingerprint"], (values["created_date"], values["splicer"]))
+
+    if to_insert:
+        # o INSERT confere o fingerprint de novo: um lançamento concorrente vira "duplicate"
+        ids = insert_records([values for _, values in to_insert], keep_duplicates=confirm_duplicates)
+        saved = [(i, values, rid) for (i, values), rid in zip(to_insert, ids) if rid is not None]
+        rollup_apply_many(Record(**values) for _, values, _ in saved)
+        db.session.commit()
+        for i, values, rid in saved:
+            results[i].update(status="saved", id=rid, total_usd=values["total_usd"])
+        for (i, _), rid in zip(to_insert, ids):
+            if rid is None:
+                results[i].update(status="duplicate", message="Este dispositivo acabou de ser lançado neste map.")
+    return results
+
+
+SYNC_STATE_COLUMNS = (
+    Record.id, Record.client_key, Record.company, Record.map, Record.type, Record.device,
+    Record.splices, Record.splicer, Record.created_date, Record.total_usd,
+)
 
 
+def sync_records(rows: list[dict], default_splicer: str) -> list[dict]:
+    """Grava a fila de um aparelho offline; cada linha traz sua "client_key".
+
+    Um único INSERT ... ON CONFLICT DO NOTHING grava só as chaves ainda não
+    vistas, então reenviar a mesma fila não duplica nada. Retorna o
+    estado do servidor para cada chave: "created", "exists" ou "error".
+    """
+    results = []
+    pending = {}
+    duplicates = set()
+    pricing = get_pricing()
+    for i, raw in enumerate(rows):
+        key = str(raw.get("client_key") or "").strip()
+        if not key or len(key) > 64:
+            results.append({"row": i, "client_key": key or None, "status": "error",
+                            "message": "client_key obrigatória (até 64 caracteres)."})
+            continue
+        values, error = parse_entry_row(raw, default_splicer)
+        if error:
+            results.append({"row": i, "client_key": key, "status": "error", "message": error})
+            continue
+        results.append({"row": i, "client_key": key, "status": "exists"})
+        if key in pending:
+            continue
+        price_splices, price_device, total = compute_prices(
+            values["splices"], values["type"] or values["device"], values["company"], pricing
+        )
+        values.update(client_key=key, price_splices_usd=price_splices, price_device_usd=price_device,
+                      total_usd=total, created_at=datetime.utcnow())
+        pending[key] = values
+
+    created = set()
+    if pending:
+        # no campo não há como confirmar duplicidade: a linha entra, mas só fica
+        # com o fingerprint se ninguém tiver a mesma chave (e avisa)
+        fps = {v["fingerprint"] for v in pending.values() if v["fingerprint"]}
+        taken = {fp for (fp,) in db.session.query(Record.fingerprint).filter(Record.fingerprint.in_(fps))} if fps else set()
+        for key, values in pending.items():
+            if values["fingerprint"] in taken:
+                values["fingerprint"] = None
+                duplicates.add(key)
+            elif values["fingerprint"]:
+                taken.add(values["fingerprint"])
+        stmt = (
+            dialect_insert(Record)
+            .values(list(pending.values()))
+            .on_conflict_do_nothing()
+            .returning(Record.id, Record.client_key)
+        )
+        created = {key for _, key in db.session.execute(stmt)}
+        rollup_apply_many(Record(**pending[key]) for key in created)
+        db.session.commit()
+
+    state = {}
+    if pending:
+        for row in db.session.execute(select(*SYNC_STATE_COLUMNS).where(Record.client_key.in_(list(pending)))).mappings():
+            state[row["client_key"]] = row
+    for result in results:
+        row = state.get(result["client_key"])
+        if result["status"] == "error":
+            continue
+        if row is None:
+            # perdeu o fingerprint para um lançamento concorrente: o aparelho reenvia
+            result.update(status="error", message="Conflito ao gravar; reenvie a linha.")
+            continue
+        if result["client_key"] in created:
+            result["status"] = "created"
+            created.discard(result["client_key"])
+            if result["client_key"] in duplicates:
+                result["warning"] = "Dispositivo já lançado neste map."
+        result["record"] = {
+            **{k: v for k, v in row.items() if k != "created_date"},
+            "created_date": row["created_date"].date().isoformat() if row["created_date"] else None,
+        }
+    return results
+
+
+# --------- Importação de planilha ---------
+IMPORT_CHUNK_SIZE = 2000
+IMPORT_MAX_ERRORS = 50
+
+# cabeçalhos aceitos (minúsculos) -> campo do lançamento
+IMPORT_HEADERS = {
+    "empresa": "company", "company": "company",
+    "map": "map", "mapa": "map",
+    "type": "type", "tipo": "type",
+    "device": "device_name", "device_name": "device_name", "dispositivo": "device_name",
+    "nome do dispositivo": "device_name",
+    "splices": "splices", "fusões": "splices", "fusoes": "splices",
+    "date": "created", "data": "created", "created": "created", "created_date": "created",
+    "splicer": "splicer", "usuário": "splicer", "usuario": "splicer",
+}
+
+IMPORT_COPY_COLUMNS = (
+    "map", "type", "splices", "device", "splicer", "created_date", "company",
+    "price_splices_usd", "price_device_usd", "total_usd", "created_at", "fingerprint",
+)
+
+
+def _import_cell(value):
+    # openpyxl devolve números como float (5.0) e datas como datetime
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    return value
+
+
+def _map_import_rows(rows):
+    """Gera (nº da linha, dict por campo) a partir de linhas cruas com cabeçalho."""
+    fields = None
+    for line, values in enumerate(rows, start=1):
+        if not values or all(v is None or str(v).strip() == "" for v in values):
+            continue
+        if fields is None:
+            fields = [IMPORT_HEADERS.get(str(v or "").strip().lower()) for v in values]
+            if "map" not in fields:
+                raise ValueError("Cabeçalho da planilha precisa ter ao menos a coluna Map.")
+            continue
+        yield line, {f: _import_cell(v) for f, v in zip(fields, values) if f}
+
+
+def iter_import_rows(stream, filename: str):
+    """Lê .xlsx (openpyxl read-only) ou .csv linha a linha, sem carregar o arquivo todo."""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext == ".xlsx":
+        from openpyxl import load_workbook
+
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            yield from _map_import_rows(wb.worksheets[0].iter_rows(values_only=True))
+        finally:
+            wb.close()
+    elif ext == ".csv":
+        text_stream = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+        sample = text_stream.read(4096)
+        text_stream.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from _map_import_rows(csv.reader(text_stream, dialect))
+    else:
+        raise ValueError("Formato não suportado: envie .xlsx ou .csv.")
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _copy_insert(rows: list[dict]) -> list:
+    """Postgres: COPY para uma tabela temporária e INSERT ... SELECT ON CONFLICT DO NOTHING.
+
+    Retorna as linhas gravadas (com as colunas do rollup).
+    """
+    cols = ", ".join(IMPORT_COPY_COLUMNS)
+    conn = db.session.connection()
+    conn.execute(text(
+        f"CREATE TEMP TABLE import_stage ON COMMIT DROP AS SELECT {cols} FROM record WITH NO DATA"
+    ))
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_value(row.get(c)) for c in IMPORT_COPY_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY import_stage ({cols}) FROM STDIN", buf)
+    finally:
+        cursor.close()
+    return conn.execute(text(
+        f"INSERT INTO record ({cols}) SELECT {cols} FROM import_stage "
+        "ON CONFLICT DO NOTHING "
+        "RETURNING created_date, company, splicer, map, device, type, splices, total_usd, price_device_usd"
+    )).mappings().all()
+
+
+def import_records(stream, filename: str, default_splicer: str, enforced_splicer: str | None = None,
+                   dry_run: bool = False, chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+    """Importa uma planilha de produção em blocos de `chunk_size` linhas.
+
+    Cada bloco é validado, precificado com o snapshot de preços do worker e
+    gravado de uma vez (COPY no Postgres, INSERT em lote nos demais), com
+    commit por bloco: memória limitada ao bloco, mesmo em arquivos de 100k
+    linhas. Dispositivos já lançados no mesmo map são pulados (fingerprint),
+    então reenviar um arquivo interrompido não duplica nada. Com dry_run nada
+    é gravado e o relatório diz o que seria importado.
+    """
+    started = time.perf_counter()
+    report = {"rows": 0, "imported": 0, "duplicates": 0, "invalid": 0, "total_usd": 0.0,
+              "errors": [], "dry_run": dry_run}
+    pricing = get_pricing()
+    use_copy = db.engine.dialect.name == "postgresql" and not dry_run
+    seen = set()
+
+    def flush(chunk):
+        fps = {v["fingerprint"] for v in chunk if v["fingerprint"]}
+        taken = {fp for (fp,) in db.session.query(Record.fingerprint).filter(Record.fingerprint.in_(fps))} if fps else set()
+        fresh = []
+        for values in chunk:
+            fp = values["fingerprint"]
+            if fp and (fp in taken or fp in seen):
+                report["duplicates"] += 1
+                continue
+            if fp:
+                seen.add(fp)
+            fresh.append(values)
+        if not fresh:
+            return
+        if dry_run:
+            report["imported"] += len(fresh)
+            report["total_usd"] += sum(v["total_usd"] for v in fresh)
+            return
+        if use_copy:
+            saved = [Record(**row) for row in _copy_insert(fresh)]
+        else:
+            ids = insert_records(fresh)
+            saved = [Record(**v) for v, rid in zip(fresh, ids) if rid is not None]
+        # o que o INSERT recusou foi lançado por outra pessoa enquanto importávamos
+        report["duplicates"] += len(fresh) - len(saved)
+        report["imported"] += len(saved)
+        report["total_usd"] += sum(r.total_usd or 0.0 for r in saved)
+        rollup_apply_many(saved)
+        db.session.commit()
+
+    chunk = []
+    for line, raw in iter_import_rows(stream, filename):
+        report["rows"] += 1
+        values, error = parse_entry_row(raw, default_splicer)
+        if error:
+            report["invalid"] += 1
+            if len(report["errors"]) < IMPORT_MAX_ERRORS:
+                report["errors"].append(f"Linha {line}: {error}")
+            continue
+        if enforced_splicer:
+            values["splicer"] = enforced_splicer
+        price_splices, price_device, total = pricing.compute(
+            values["splices"], values["type"] or values["device"], values["company"]
+        )
+        values.update(price_splices_usd=price_splices, price_device_usd=price_device,
+                      total_usd=total, created_at=datetime.utcnow())
+        chunk.append(values)
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    report["total_usd"] = round(report["total_usd"], 2)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
 
 # --------- Decorators ---------
 
-def admin_required(f):
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not getattr(current_user, "is_admin", False):
+            flash("Apenas o administrador pode acessar essa área.", "danger")
+            return redirect(url_for("main.index"))
+        return f(*args, **kwargs)
+    return wrapper
+
+def read_replica(f):
+    """Rota só de leitura: com DATABASE_REPLICA_URL, GETs consultam a réplica.
+
+    Quem gravou há menos de REPLICA_STICKY_SECONDS continua lendo do primário,
+    para ver o próprio lançamento logo depois do redirect.
+    """
     @wraps(f)
-    @login_required
     def wrapper(*args, **kwargs):
-        if not getattr(current_user, "is_admin", False):
-            flash("Apenas o administrador pode acessar essa área.", "danger")
-            return redirect(url_for("index"))
+        if (
+            "replica" in current_app.config.get("SQLALCHEMY_BINDS", {})
+            and request.method in ("GET", "HEAD")
+            and session.get("primary_until", 0) < time.time()
+        ):
+            g.db_replica = True
         return f(*args, **kwargs)
     return wrapper
 
+
+@bp.after_app_request
+def remember_primary_reads(response):
+    # lançamento/edição nesta requisição: as próximas leituras deste usuário vão para o primário
+    if g.get("db_wrote") and "replica" in current_app.config.get("SQLALCHEMY_BINDS", {}):
+        session["primary_until"] = time.time() + current_app.config["REPLICA_STICKY_SECONDS"]
+    return response
+
 # --------- Rotas ---------
-@app.route("/", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
 @login_required
+@read_replica
 def index():
-    # Importar planilha foi removido do sistema; qualquer POST apenas mostra aviso.
+    # importação de planilha (.xlsx / .csv)
     if request.method == "POST":
-        flash("A importação de planilha foi desativada neste sistema.", "warning")
-        return redirect(url_for("index"))
-
-    # filtros
-    company_filter = request.args.get("company") or None
-    splicer_filter = request.args.get("splicer") or None
-    map_filter = request.args.get("map") or None
-    device_filter = request.args.get("device") or None
-    start_raw = request.args.get("start") or None
-    end_raw = request.args.get("end") or None
-
-    # base da consulta
-    query = Record.query
-
-    # filtros principais
-    if company_filter:
-        query = query.filter(Record.company == company_filter)
-    if splicer_filter and getattr(current_user, "is_admin", False):
-        # só admin pode aplicar filtro por splicer diferente
-        query = query.filter(Record.splicer == splicer_filter)
-    if map_filter:
-        query = query.filter(Record.map.ilike(f"%{map_filter}%"))
-    if device_filter:
-        query = query.filter(Record.device.ilike(f"%{device_filter}%"))
-
-    if start_raw:
-        try:
-            start_dt = datetime.fromisoformat(start_raw)
-            query = query.filter(Record.created_date >= start_dt)
-        except ValueError:
-            pass
-    if end_raw:
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            flash("Selecione uma planilha .xlsx ou .csv.", "danger")
+            return redirect(url_for("main.index"))
+
+        default_splicer = getattr(current_user, "splicer_name", None) or current_user.username
+        enforced = None if getattr(current_user, "is_admin", False) else default_splicer
+        dry_run = request.form.get("dry_run") == "1"
         try:
-            end_dt = datetime.fromisoformat(end_raw)
-            query = query.filter(Record.created_date <= end_dt)
-        except ValueError:
-            pass
-
-    # se não for admin, restringe SEMPRE aos lançamentos do próprio usuário
-    enforced_splicer = None
-    if not getattr(current_user, "is_admin", False):
-        enforced_splicer = getattr(current_user, "splicer_name", None) or current_user.username
-        query = query.filter(Record.splicer == enforced_splicer)
+            report = import_records(upload.stream, upload.filename, default_splicer, enforced, dry_run=dry_run)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), "danger")
+            return redirect(url_for("main.index"))
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("falha ao importar %s", upload.filename)
+            flash("Não foi possível ler a planilha.", "danger")
+            return redirect(url_for("main.index"))
+
+        verb = "seriam importados" if dry_run else "importados"
+        flash(
+            f"{upload.filename}: {report['rows']} linhas lidas, {report['imported']} {verb} "
+            f"($ {report['total_usd']:.2f}), {report['duplicates']} duplicados, {report['invalid']} inválidos.",
+            "info" if dry_run else "success",
+        )
+        if report["errors"]:
+            flash(" · ".join(report["errors"][:5]), "warning")
+        return redirect(url_for("main.index"))
 
-    records = query.order_by(Record.created_date.desc().nullslast(), Record.id.desc()).all()
-    total_rows = len(records)
-    total_amount = sum(r.total_usd or 0 for r in records)
+    # filtros (usuário comum fica sempre restrito aos próprios lançamentos)
+    filt = RecordFilter.from_args(request.args, current_user)
+    query = filt.query()
 
-    companies = [c.name for c in CompanyConfig.query.order_by(CompanyConfig.name).all()]
-    # também empresas já usadas em registros
-    companies_from_records = {
-        c for (c,) in db.session.query(Record.company).distinct().all() if c
-    }
+    # totais do filtro inteiro (não só da página atual)
+    totals = filter_totals(filt)
 
-    all_companies = sorted(set(companies) | companies_from_records)
+    try:
+        per_page = int(request.args.get("per_page") or current_app.config["RECORDS_PER_PAGE"])
+    except ValueError:
+        per_page = current_app.config["RECORDS_PER_PAGE"]
+    per_page = max(1, min(per_page, 1000))
+
+    records, next_cursor, prev_cursor = paginate_records(
+        query,
+        after=decode_cursor(request.args.get("after")),
+        before=decode_cursor(request.args.get("before")),
+        per_page=per_page,
+    )
 
-    # lista de splicers / usuários cadastrados (para o filtro)
-    splicers_from_records = {
-        s for (s,) in db.session.query(Record.splicer).distinct().all() if s
-    }
-    splicers_from_users = {
-        (u.splicer_name or u.username)
-        for u in User.query.all()
-        if (u.splicer_name or u.username)
-    }
-    all_splicers = sorted(splicers_from_records | splicers_from_users)
+    # empresas (cadastradas + já usadas) e splicers (lançamentos + usuários), em cache
+    dims = get_dimensions()
+    all_companies = dims.companies
+    all_splicers = dims.splicers
 
     # para usuários comuns, o dropdown não deve listar outros nomes
-    if not getattr(current_user, "is_admin", False):
-        if enforced_splicer:
-            all_splicers = [enforced_splicer]
-            splicer_filter = enforced_splicer
-        else:
-            enforced_splicer = getattr(current_user, "splicer_name", None) or current_user.username
-            all_splicers = [enforced_splicer]
-            splicer_filter = enforced_splicer
+    splicer_filter = filt.splicer
+    if filt.enforced_splicer:
+        all_splicers = [filt.enforced_splicer]
+        splicer_filter = filt.enforced_splicer
 
     return render_template(
         "index.html",
         records=records,
-        total_rows=total_rows,
-        total_amount=total_amount,
+        total_rows=totals["rows"],
+        total_amount=totals["amount"],
+        total_splices=totals["splices"],
+        total_hubs=totals["hubs"],
         companies=all_companies,
         splicers=all_splicers,
-        company_filter=company_filter or "",
+        company_filter=filt.company or "",
         splicer_filter=splicer_filter or "",
-        map_filter=map_filter or "",
-        device_filter=device_filter or "",
-        start=start_raw or "",
-        end=end_raw or "",
+        map_filter=filt.map or "",
+        device_filter=filt.device or "",
+        start=filt.start or "",
+        end=filt.end or "",
+        per_page=per_page,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
     )
 
-@app.route("/entry", methods=["GET", "POST"])
+@bp.route("/entry", methods=["GET", "POST"])
 @login_required
 def entry():
     """Lançamento manual de produção (uma linha por vez)."""
-    # empresas configuradas
-    companies = [c.name for c in CompanyConfig.query.order_by(CompanyConfig.name).all()]
-
-    # mapas cadastrados por empresa
-    maps_by_company = {}
-    for m in CompanyMap.query.order_by(CompanyMap.company, CompanyMap.name).all():
-        maps_by_company.setdefault(m.company, []).append(m.name)
-
-    # dispositivos cadastrados por empresa
-    devices_by_company = {}
-    for dt in DeviceType.query.order_by(DeviceType.company, DeviceType.name).all():
-        key = dt.company or "__global__"
-        devices_by_company.setdefault(key, []).append(dt.name)
+    # empresas configuradas; dispositivos vêm de /api/lookups e mapas de /api/maps
+    lookups = get_lookups()
 
     default_splicer = getattr(current_user, "splicer_name", None) or current_user.username
 
@@ -336,6 +2287,9 @@ def entry():
         map_val = (request.form.get("map") or "").strip()
         type_val = (request.form.get("type") or "").strip()
         device_name = (request.form.get("device_name") or "").strip()
+        if not map_val:
+            flash(ENTRY_MAP_REQUIRED, "danger")
+            return redirect(url_for("main.entry"))
 
         # para cálculo de preço usamos o tipo (dispositivo configurado),
         # e guardamos o nome digitado separado
@@ -346,40 +2300,6 @@ def entry():
         splicer = (request.form.get("splicer") or "").strip() or default_splicer
         confirm_duplicate = (request.form.get("confirm_duplicate") == "yes")
 
-        # checagem de duplicidade: mesmo map + mesmo nome de dispositivo (+ mesma empresa, se informada)
-        existing = None
-        if map_val and device_name:
-            dup_query = Record.query.filter(Record.map == map_val, Record.device == device_name)
-            if company:
-                dup_query = dup_query.filter(Record.company == company)
-            existing = dup_query.order_by(Record.created_date.desc().nullslast(), Record.id.desc()).first()
-
-        if existing and not confirm_duplicate:
-            # Primeiro aviso: já existe lançamento para este dispositivo neste mapa.
-            # Mostra data e splicer e pede confirmação para lançar novamente.
-            flash(
-                "Este dispositivo já foi lançado neste map. Data: "
-                + (existing.created_date.date().isoformat() if existing.created_date else "-")
-                + f", Splicer: {existing.splicer}. Se desejar lançar novamente, confirme o lançamento.",
-                "warning",
-            )
-            return render_template(
-                "entry.html",
-                companies=companies,
-                maps_by_company=maps_by_company,
-                devices_by_company=devices_by_company,
-                default_splicer=default_splicer,
-                today=date.today().isoformat(),
-                duplicate_record=existing,
-                form_company=company,
-                form_map=map_val,
-                form_type=type_val,
-                form_device_name=device_name,
-                form_splices=splices_raw,
-                form_created=created_raw or date.today().isoformat(),
-                confirm_duplicate=True,
-            )
-
         # conversões finais para salvar o registro
         try:
             splices = int(splices_raw or 0)
@@ -399,7 +2319,7 @@ def entry():
 
         price_splices, price_device, total = compute_prices(splices, device_for_price, company)
 
-        rec = Record(
+        values = dict(
             map=map_val,
             type=type_val,
             splices=splices,
@@ -410,25 +2330,179 @@ def entry():
             price_splices_usd=price_splices,
             price_device_usd=price_device,
             total_usd=total,
+            created_at=datetime.utcnow(),
+            fingerprint=record_fingerprint(company, map_val, device_name),
         )
-        db.session.add(rec)
+        # checagem de duplicidade no próprio INSERT: mesma empresa + map + nome de dispositivo
+        (rid,) = insert_records([values], keep_duplicates=confirm_duplicate)
+        existing = None
+        if rid is None:
+            existing = Record.query.filter_by(fingerprint=values["fingerprint"]).first()
+            if existing is None:
+                # quem tinha a chave foi apagado entre o INSERT e a consulta: não é duplicata
+                (rid,) = insert_records([values], keep_duplicates=True)
+
+        if rid is None:
+            # Primeiro aviso: já existe lançamento para este dispositivo neste mapa.
+            # Mostra data e splicer e pede confirmação para lançar novamente.
+            flash(
+                "Este dispositivo já foi lançado neste map. Data: "
+                + (existing.created_date.date().isoformat() if existing.created_date else "-")
+                + f", Splicer: {existing.splicer}. Se desejar lançar novamente, confirme o lançamento.",
+                "warning",
+            )
+            return render_template(
+                "entry.html",
+                companies=lookups.companies,
+                lookups_url=url_for("main.api_lookups", v=lookups.version),
+                default_splicer=default_splicer,
+                today=date.today().isoformat(),
+                duplicate_record=existing,
+                form_company=company,
+                form_map=map_val,
+                form_type=type_val,
+                form_device_name=device_name,
+                form_splices=splices_raw,
+                form_created=created_raw or date.today().isoformat(),
+                confirm_duplicate=True,
+            )
+
+        rollup_apply(Record(**values))
         db.session.commit()
         flash("Lançamento salvo.", "success")
         # após salvar, permanece na tela de lançamento para permitir novo registro
-        return redirect(url_for("entry"))
+        return redirect(url_for("main.entry"))
 
 # GET
     return render_template(
         "entry.html",
-        companies=companies,
-        maps_by_company=maps_by_company,
-        devices_by_company=devices_by_company,
+        companies=lookups.companies,
+        lookups_url=url_for("main.api_lookups", v=lookups.version),
+        default_splicer=default_splicer,
+        today=date.today().isoformat(),
+    )
+
+
+@bp.route("/entry/batch", methods=["GET", "POST"])
+@login_required
+def entry_batch():
+    """Lançamento de várias linhas de uma vez (grid do formulário ou JSON {"rows": [...]})."""
+    default_splicer = getattr(current_user, "splicer_name", None) or current_user.username
+    lookups = get_lookups()
+    rows, results = [], None
+
+    if request.method == "POST":
+        if request.is_json:
+            payload = request.get_json(silent=True) or {}
+            rows = payload.get("rows") or []
+            confirm_duplicates = bool(payload.get("confirm_duplicates"))
+        else:
+            columns = {f: request.form.getlist(f) for f in BATCH_ENTRY_FIELDS}
+            count = max((len(v) for v in columns.values()), default=0)
+            rows = [{f: (v[i] if i < len(v) else "") for f, v in columns.items()} for i in range(count)]
+            confirm_duplicates = request.form.get("confirm_duplicate") == "yes"
+
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            if request.is_json:
+                return jsonify({"error": "rows deve ser uma lista de objetos."}), 400
+            abort(400)
+        if len(rows) > BATCH_ENTRY_MAX_ROWS:
+            message = f"Máximo de {BATCH_ENTRY_MAX_ROWS} linhas por lote."
+            if request.is_json:
+                return jsonify({"error": message}), 400
+            flash(message, "danger")
+            return redirect(url_for("main.entry_batch"))
+
+        results = save_entry_batch(rows, default_splicer, confirm_duplicates)
+        counts = {}
+        for r in results:
+            counts[r["status"]] = counts.get(r["status"], 0) + 1
+        if request.is_json:
+            return jsonify({"saved": counts.get("saved", 0), "results": results})
+
+        flash(f"{counts.get('saved', 0)} lançamento(s) salvos.", "success")
+        if counts.get("duplicate") or counts.get("error"):
+            flash(
+                f"{counts.get('duplicate', 0)} duplicado(s) e {counts.get('error', 0)} com erro não foram salvos; "
+                "revise as linhas abaixo.",
+                "warning",
+            )
+        # reapresenta só as linhas que não foram gravadas
+        keep = [i for i, r in enumerate(results) if r["status"] in ("duplicate", "error")]
+        rows = [rows[i] for i in keep]
+        results = [results[i] for i in keep]
+
+    return render_template(
+        "entry_batch.html",
+        companies=lookups.companies,
+        lookups_url=url_for("main.api_lookups", v=lookups.version),
         default_splicer=default_splicer,
         today=date.today().isoformat(),
+        rows=rows,
+        results=results,
+        blank_rows=max(0, 10 - len(rows)),
     )
 
 
-@app.route("/record/<int:rid>/edit", methods=["GET", "POST"])
+@bp.route("/api/sync", methods=["POST"])
+@login_required
+def api_sync():
+    """Sincroniza a fila de lançamentos de um aparelho offline: {"rows": [{..., "client_key": ...}]}."""
+    payload = request.get_json(silent=True) or {}
+    rows = payload.get("rows")
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        return jsonify({"error": "rows deve ser uma lista de objetos."}), 400
+    if len(rows) > BATCH_ENTRY_MAX_ROWS:
+        return jsonify({"error": f"Máximo de {BATCH_ENTRY_MAX_ROWS} linhas por sincronização."}), 400
+
+    default_splicer = getattr(current_user, "splicer_name", None) or current_user.username
+    results = sync_records(rows, default_splicer)
+    created = sum(1 for r in results if r["status"] == "created")
+    return jsonify({"created": created, "results": results, "server_time": datetime.utcnow().isoformat()})
+
+
+@bp.route("/api/lookups")
+@login_required
+def api_lookups():
+    """Empresas e dispositivos do formulário de lançamento (JSON com ETag).
+
+    A tela pede a URL com ?v=<versão>; se for a versão atual, o navegador pode
+    guardar a resposta por um dia, já que qualquer mudança gera outra URL.
+    """
+    lookups = get_lookups()
+    resp = Response(lookups.body, mimetype="application/json")
+    resp.set_etag(lookups.etag)
+    if request.args.get("v") == str(lookups.version):
+        resp.headers["Cache-Control"] = "private, max-age=86400"
+    else:
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+
+@bp.route("/api/pool-stats")
+@admin_required
+def api_pool_stats():
+    """Métricas do pool de conexões do worker que atendeu (para dimensionar o gunicorn)."""
+    return jsonify(pool_stats.snapshot(db.engine.pool))
+
+
+@bp.route("/api/maps")
+@login_required
+def api_maps():
+    """Autocomplete de mapas: /api/maps?company=...&q=<prefixo>&limit=20."""
+    company = (request.args.get("company") or "").strip()
+    prefix = (request.args.get("q") or "").strip()
+    try:
+        limit = int(request.args.get("limit") or MAP_SEARCH_LIMIT)
+    except ValueError:
+        limit = MAP_SEARCH_LIMIT
+    limit = max(1, min(limit, MAP_SEARCH_MAX_LIMIT))
+    if not company:
+        return jsonify({"maps": []})
+    return jsonify({"maps": list(search_maps(current_version("lookups"), company, prefix, limit))})
+
+
+@bp.route("/record/<int:rid>/edit", methods=["GET", "POST"])
 @login_required
 def record_edit(rid):
     """Editar um lançamento existente."""
@@ -437,19 +2511,10 @@ def record_edit(rid):
     # Apenas admin ou o próprio splicer podem editar
     if not getattr(current_user, "is_admin", False) and rec.splicer != current_user.username:
         flash("Você não tem permissão para editar este lançamento.", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     # mesmas estruturas de apoio usadas na tela de lançamento
-    companies = [c.name for c in CompanyConfig.query.order_by(CompanyConfig.name).all()]
-
-    maps_by_company = {}
-    for m in CompanyMap.query.order_by(CompanyMap.company, CompanyMap.name).all():
-        maps_by_company.setdefault(m.company, []).append(m.name)
-
-    devices_by_company = {}
-    for dt in DeviceType.query.order_by(DeviceType.company, DeviceType.name).all():
-        key = dt.company or "__global__"
-        devices_by_company.setdefault(key, []).append(dt.name)
+    lookups = get_lookups()
 
     default_splicer = getattr(current_user, "splicer_name", None) or current_user.username
 
@@ -481,7 +2546,11 @@ def record_edit(rid):
 
         price_splices, price_device, total = compute_prices(splices, device_for_price, company)
 
-        # atualiza o registro existente
+        # atualiza o registro existente (tira os valores antigos do rollup e soma os novos)
+        rollup_apply(rec, -1)
+        fingerprint = record_fingerprint(company, map_val, device_name)
+        if fingerprint != rec.fingerprint:
+            release_fingerprint(rec)
         rec.company = company
         rec.map = map_val
         rec.type = type_val
@@ -492,19 +2561,22 @@ def record_edit(rid):
         rec.price_splices_usd = price_splices
         rec.price_device_usd = price_device
         rec.total_usd = total
+        rollup_apply(rec)
+        # fica com o novo fingerprint se ninguém mais tiver a mesma chave
+        if fingerprint and rec.fingerprint is None:
+            claim_fingerprint(rec, fingerprint)
 
         db.session.commit()
         flash("Lançamento atualizado.", "success")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     # GET: preenche o formulário com os dados atuais
     form_created = rec.created_date.date().isoformat() if rec.created_date else date.today().isoformat()
 
     return render_template(
         "entry.html",
-        companies=companies,
-        maps_by_company=maps_by_company,
-        devices_by_company=devices_by_company,
+        companies=lookups.companies,
+        lookups_url=url_for("main.api_lookups", v=lookups.version),
         default_splicer=default_splicer,
         today=date.today().isoformat(),
         is_edit=True,
@@ -517,14 +2589,14 @@ def record_edit(rid):
         form_created=form_created,
     )
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for("login"))
+    return redirect(url_for("main.login"))
 
 
-@app.route("/settings", methods=["GET"])
+@bp.route("/settings", methods=["GET"])
 @admin_required
 def settings():
     """Tela principal de cadastro de empresas."""
@@ -536,7 +2608,7 @@ def settings():
         db.session.commit()
     return render_template("settings.html", companies=companies, syscfg=syscfg)
 
-@app.route("/settings/company/add", methods=["POST"])
+@bp.route("/settings/company/add", methods=["POST"])
 @login_required
 def settings_company_add():
     name = (request.form.get("name") or "").strip()
@@ -546,7 +2618,7 @@ def settings_company_add():
 
     if not name:
         flash("Nome da empresa é obrigatório.", "danger")
-        return redirect(url_for("settings"))
+        return redirect(url_for("main.settings"))
 
     cfg = CompanyConfig.query.filter_by(name=name).first()
     if cfg:
@@ -555,12 +2627,15 @@ def settings_company_add():
     else:
         cfg = CompanyConfig(name=name, included_splices=included, invoice_address=invoice_address)
         db.session.add(cfg)
+        bump_version("dimensions")
+        bump_version("lookups")
+    bump_version("pricing")
     db.session.commit()
     flash("Empresa / fusões inclusas salva.", "success")
-    return redirect(url_for("settings"))
+    return redirect(url_for("main.settings"))
 
 
-@app.route("/settings/company/<int:cid>", methods=["GET", "POST"])
+@bp.route("/settings/company/<int:cid>", methods=["GET", "POST"])
 @admin_required
 def settings_company_detail(cid: int):
     company = CompanyConfig.query.get_or_404(cid)
@@ -571,9 +2646,10 @@ def settings_company_detail(cid: int):
         mp = CompanyMap.query.get(int(del_map_id))
         if mp and mp.company == company.name:
             db.session.delete(mp)
+            bump_version("lookups")
             db.session.commit()
             flash("Mapa removido.", "success")
-        return redirect(url_for("settings_company_detail", cid=company.id))
+        return redirect(url_for("main.settings_company_detail", cid=company.id))
 
     # inclusão de mapa via POST
     if request.method == "POST":
@@ -582,24 +2658,64 @@ def settings_company_detail(cid: int):
             exists = CompanyMap.query.filter_by(company=company.name, name=new_map).first()
             if not exists:
                 db.session.add(CompanyMap(company=company.name, name=new_map))
+                bump_version("lookups")
                 db.session.commit()
                 flash("Mapa adicionado.", "success")
-        return redirect(url_for("settings_company_detail", cid=company.id))
+        return redirect(url_for("main.settings_company_detail", cid=company.id))
 
     types = DeviceType.query.filter_by(company=company.name).order_by(DeviceType.name).all()
     tiers = SpliceTier.query.filter_by(company=company.name).order_by(SpliceTier.min_splices).all()
     maps = CompanyMap.query.filter_by(company=company.name).order_by(CompanyMap.name).all()
+    # últimas reprecificações desta empresa (a empresa vai nos parâmetros do job)
+    recent = ExportJob.query.filter_by(kind="reprice").order_by(ExportJob.id.desc()).limit(50)
+    reprice_jobs = [job for job in recent if json.loads(job.params or "{}").get("company") == company.name][:5]
     return render_template(
         "settings_company.html",
         company=company,
         types=types,
         tiers=tiers,
         maps=maps,
+        reprice_jobs=reprice_jobs,
     )
 
 
 
-@app.route("/settings/system", methods=["POST"])
+@bp.route("/settings/company/<int:cid>/reprice", methods=["POST"])
+@admin_required
+def settings_company_reprice(cid: int):
+    """Coloca na fila o recálculo dos valores da empresa no período informado."""
+    company = CompanyConfig.query.get_or_404(cid)
+    start_raw = request.form.get("start") or None
+    end_raw = request.form.get("end") or None
+    dry_run = request.form.get("dry_run") == "1"
+
+    try:
+        start_dt = datetime.fromisoformat(start_raw) if start_raw else None
+        end_dt = datetime.fromisoformat(end_raw) if end_raw else None
+    except ValueError:
+        flash("Data inválida.", "danger")
+        return redirect(url_for("main.settings_company_detail", cid=company.id))
+
+    # roda na fila de jobs: o volume pode passar do timeout do gunicorn e do statement_timeout
+    params = {"company": company.name, "dry_run": "1" if dry_run else ""}
+    if start_dt:
+        params["start"] = start_dt.isoformat()
+    if end_dt:
+        params["end"] = end_dt.isoformat()
+    job = ExportJob(
+        kind="reprice",
+        params=json.dumps(params),
+        user_id=current_user.id,
+        expires_at=datetime.utcnow() + timedelta(seconds=current_app.config["EXPORT_TTL"]),
+    )
+    db.session.add(job)
+    db.session.commit()
+    dispatch_export_job(job.id)
+    flash(("Simulação" if dry_run else "Reprecificação") + " enviada para a fila; acompanhe abaixo.", "info")
+    return redirect(url_for("main.settings_company_detail", cid=company.id))
+
+
+@bp.route("/settings/system", methods=["POST"])
 @admin_required
 def settings_system_update():
     """Atualiza os dados da sua empresa (emitente da invoice)."""
@@ -622,9 +2738,9 @@ def settings_system_update():
 
     db.session.commit()
     flash("Dados da sua empresa atualizados.", "success")
-    return redirect(url_for("settings"))
+    return redirect(url_for("main.settings"))
 
-@app.route("/settings/device/add", methods=["POST"])
+@bp.route("/settings/device/add", methods=["POST"])
 @login_required
 def settings_device_add():
     name = (request.form.get("name") or "").strip()
@@ -637,7 +2753,7 @@ def settings_device_add():
         value = 0.0
     if not name:
         flash("Nome do dispositivo é obrigatório.", "danger")
-        return redirect(next_url or url_for("settings"))
+        return redirect(next_url or url_for("main.settings"))
 
     dt = DeviceType.query.filter_by(name=name, company=company).first()
     if dt:
@@ -645,9 +2761,11 @@ def settings_device_add():
     else:
         dt = DeviceType(name=name, company=company, value_usd=value)
         db.session.add(dt)
+        bump_version("lookups")
+    bump_version("pricing")
     db.session.commit()
     flash("Dispositivo salvo.", "success")
-    return redirect(next_url or url_for("settings"))
+    return redirect(next_url or url_for("main.settings"))
 
     dt = DeviceType.query.filter_by(name=name, company=company).first()
     if dt:
@@ -657,21 +2775,23 @@ def settings_device_add():
         db.session.add(dt)
     db.session.commit()
     flash("Dispositivo salvo.", "success")
-    return redirect(url_for("settings"))
+    return redirect(url_for("main.settings"))
 
 
-@app.route("/settings/device/<int:did>/delete")
+@bp.route("/settings/device/<int:did>/delete")
 @login_required
 def settings_device_delete(did: int):
     next_url = request.args.get("next") or None
     dt = DeviceType.query.get_or_404(did)
     db.session.delete(dt)
+    bump_version("pricing")
+    bump_version("lookups")
     db.session.commit()
     flash("Dispositivo removido.", "success")
-    return redirect(next_url or url_for("settings"))
+    return redirect(next_url or url_for("main.settings"))
 
 
-@app.route("/settings/tier/add", methods=["POST"])
+@bp.route("/settings/tier/add", methods=["POST"])
 @login_required
 def settings_tier_add():
     company = (request.form.get("company") or "").strip() or None
@@ -692,7 +2812,7 @@ def settings_tier_add():
 
     if min_s < 0:
         flash("Splices mín. não pode ser negativo.", "danger")
-        return redirect(next_url or url_for("settings"))
+        return redirect(next_url or url_for("main.settings"))
 
     tier = SpliceTier(
         company=company,
@@ -701,25 +2821,27 @@ def settings_tier_add():
         price_per_splice_usd=price,
     )
     db.session.add(tier)
+    bump_version("pricing")
     db.session.commit()
     flash("Faixa de fusões salva.", "success")
-    return redirect(next_url or url_for("settings"))
+    return redirect(next_url or url_for("main.settings"))
 
 
-@app.route("/settings/tier/<int:tid>/delete")
+@bp.route("/settings/tier/<int:tid>/delete")
 @login_required
 def settings_tier_delete(tid: int):
     next_url = request.args.get("next") or None
     tier = SpliceTier.query.get_or_404(tid)
     db.session.delete(tier)
+    bump_version("pricing")
     db.session.commit()
     flash("Faixa de fusões removida.", "success")
-    return redirect(next_url or url_for("settings"))
+    return redirect(next_url or url_for("main.settings"))
 
 
 
 
-@app.route("/users", methods=["GET", "POST"])
+@bp.route("/users", methods=["GET", "POST"])
 @admin_required
 def manage_users():
     """Cadastro simples de usuários. Apenas admin acessa."""
@@ -731,7 +2853,7 @@ def manage_users():
 
         if not username or not password:
             flash("Usuário e senha são obrigatórios.", "danger")
-            return redirect(url_for("manage_users"))
+            return redirect(url_for("main.manage_users"))
 
         user = User.query.filter_by(username=username).first()
         if user:
@@ -746,76 +2868,93 @@ def manage_users():
                 is_admin=is_admin,
             )
             db.session.add(user)
+        bump_version("dimensions")
         db.session.commit()
         flash("Usuário salvo com sucesso.", "success")
-        return redirect(url_for("manage_users"))
+        return redirect(url_for("main.manage_users"))
 
     users = User.query.order_by(User.username).all()
     return render_template("users.html", users=users)
 
-@app.route("/users/<int:uid>/delete")
+@bp.route("/users/<int:uid>/delete")
 @admin_required
 def user_delete(uid: int):
     user = User.query.get_or_404(uid)
     if user.username == "admin":
         flash("Não é permitido remover o usuário admin.", "danger")
-        return redirect(url_for("manage_users"))
+        return redirect(url_for("main.manage_users"))
     if current_user.id == user.id:
         flash("Você não pode remover o próprio usuário logado.", "danger")
-        return redirect(url_for("manage_users"))
+        return redirect(url_for("main.manage_users"))
     db.session.delete(user)
+    bump_version("dimensions")
     db.session.commit()
     flash("Usuário removido.", "success")
-    return redirect(url_for("manage_users"))
+    return redirect(url_for("main.manage_users"))
+
+class ExportError(Exception):
+    """Filtro inválido para um export; a mensagem vai para o flash (ou para o job)."""
 
-@app.route("/export/pdf")
+    def __init__(self, message: str, category: str = "danger"):
+        super().__init__(message)
+        self.category = category
 
+
+def send_export(kind: str):
+    """Gera o export na própria requisição e envia o arquivo."""
+    out = tempfile.TemporaryFile()
+    try:
+        filename, mimetype = EXPORT_RENDERERS[kind](out, request.args, current_user)
+    except ExportError as exc:
+        out.close()
+        flash(str(exc), exc.category)
+        return redirect(url_for("main.index"))
+    out.seek(0)
+    return send_file(out, as_attachment=True, download_name=filename, mimetype=mimetype)
+
+
+PDF_REPORT_BATCH = 1000
+PDF_REPORT_COLUMNS = (
+    Record.created_date, Record.company, Record.map, Record.type, Record.device,
+    Record.splices, Record.price_splices_usd, Record.total_usd,
+)
+
+
+@bp.route("/export/pdf")
 @login_required
+@read_replica
 def export_pdf():
-    """Gera um PDF simples com os registros filtrados (mesma lógica da tela principal)."""
-    # mesmos filtros do index
-    company_filter = request.args.get("company") or None
-    splicer_filter = request.args.get("splicer") or None
-    map_filter = request.args.get("map") or None
-    device_filter = request.args.get("device") or None
-    start_raw = request.args.get("start") or None
-    end_raw = request.args.get("end") or None
-    no_values = request.args.get("no_values") == "1"
+    return send_export("pdf")
 
-    query = Record.query
-    if company_filter:
-        query = query.filter(Record.company == company_filter)
-    if splicer_filter:
-        query = query.filter(Record.splicer == splicer_filter)
-    if map_filter:
-        query = query.filter(Record.map.ilike(f"%{map_filter}%"))
-    if device_filter:
-        query = query.filter(Record.device.ilike(f"%{device_filter}%"))
-
-    if start_raw:
-        try:
-            start_dt = datetime.fromisoformat(start_raw)
-            query = query.filter(Record.created_date >= start_dt)
-        except ValueError:
-            pass
-    if end_raw:
-        try:
-            end_dt = datetime.fromisoformat(end_raw)
-            query = query.filter(Record.created_date <= end_dt)
-        except ValueError:
-            pass
 
-    # se não for admin, restringe aos lançamentos do próprio usuário
-    if not getattr(current_user, "is_admin", False):
-        enforced_splicer = getattr(current_user, "splicer_name", None) or current_user.username
-        query = query.filter(Record.splicer == enforced_splicer)
+def render_pdf_report(out, args, user, progress=None):
+    """Gera um PDF simples com os registros filtrados (mesma lógica da tela principal).
 
-    records = query.order_by(Record.created_date.desc().nullslast(), Record.id.desc()).all()
+    As linhas vêm do banco em blocos, mas o FPDF guarda o documento inteiro até o
+    output(): a memória do PDF ainda cresce com o número de linhas.
+    """
+    # mesmos filtros do index
+    filt = RecordFilter.from_args(args, user)
+    no_values = args.get("no_values") == "1"
 
     # totais do período
-    total_amount = sum((r.total_usd or 0) for r in records)
-    total_splices = sum((r.splices or 0) for r in records)
-    total_hubs = sum(1 for r in records if (r.type or "").upper() == "HUB")
+    totals = filter_totals(filt)
+    total_amount = totals["amount"]
+    total_splices = totals["splices"]
+    total_hubs = totals["hubs"]
+
+    if progress:
+        progress(0.3)
+
+    # só as colunas impressas, lidas em blocos por um cursor no servidor
+    records = (
+        filt.apply(db.session.query(*PDF_REPORT_COLUMNS))
+        .order_by(Record.created_date.desc().nullslast(), Record.id.desc())
+        .execution_options(stream_results=True)
+        .yield_per(PDF_REPORT_BATCH)
+    )
+
+    from fpdf import FPDF
 
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
@@ -868,16 +3007,16 @@ def export_pdf():
             pdf.cell(w, 6, str(val)[:16], border=1)  # corta textos muito grandes
         pdf.ln()
 
-    buf = BytesIO()
-    pdf.output(buf)
-    buf.seek(0)
-    filename = "relatorio_producao.pdf"
-    return send_file(buf, as_attachment=True, download_name=filename, mimetype="application/pdf")
+    if progress:
+        progress(0.9)
+    pdf.output(out)
+    return "relatorio_producao.pdf", "application/pdf"
 
 
 
-@app.route("/invoices")
+@bp.route("/invoices")
 @admin_required
+@read_replica
 def invoices_list():
     """Lista simples de todas as invoices para controle contábil."""
     status_filter = request.args.get("status") or None
@@ -888,106 +3027,53 @@ def invoices_list():
     return render_template("invoices.html", invoices=invoices, status_filter=status_filter)
 
 
-@app.route("/invoice/<int:iid>/toggle", methods=["POST"])
+@bp.route("/invoice/<int:iid>/toggle", methods=["POST"])
 @admin_required
 def invoice_toggle_status(iid: int):
     inv = Invoice.query.get_or_404(iid)
     inv.status = "paid" if inv.status != "paid" else "pending"
     db.session.commit()
     flash("Invoice status updated.", "success")
-    return redirect(url_for("invoices_list"))
+    return redirect(url_for("main.invoices_list"))
 
-@app.route("/invoice/<int:iid>/delete", methods=["POST"])
+@bp.route("/invoice/<int:iid>/delete", methods=["POST"])
 @admin_required
 def invoice_delete(iid: int):
     inv = Invoice.query.get_or_404(iid)
     db.session.delete(inv)
     db.session.commit()
     flash("Invoice deleted.", "success")
-    return redirect(url_for("invoices_list"))
-@app.route("/export/invoice")
+    return redirect(url_for("main.invoices_list"))
+@bp.route("/export/invoice")
 @login_required
+@read_replica
 def export_invoice():
+    return send_export("invoice")
+
+
+def render_invoice(out, args, user, progress=None):
     """Gera uma invoice (nota de cobrança) em PDF para o intervalo de datas e filtros informados.
 
     A invoice contém: nome do mapa, número do dispositivo, número de fusões,
     valor do dispositivo e total, somados por mapa/dispositivo no período.
     """
     # mesmos filtros do index / export_pdf
-    company_filter = request.args.get("company") or None
-    splicer_filter = request.args.get("splicer") or None
-    map_filter = request.args.get("map") or None
-    device_filter = request.args.get("device") or None
-    start_raw = request.args.get("start") or None
-    end_raw = request.args.get("end") or None
-    no_values = False  # sempre com valores na invoice
+    filt = RecordFilter.from_args(args, user)
+    company_filter = filt.company
 
     # invoice só pode ser gerada para UMA empresa específica
     if not company_filter:
-        flash("Para gerar invoice, selecione uma empresa específica (filtro de empresa).", "danger")
-        return redirect(url_for("index"))
-
-    query = Record.query
-
-    if company_filter:
-        query = query.filter(Record.company == company_filter)
-    if splicer_filter and getattr(current_user, "is_admin", False):
-        query = query.filter(Record.splicer == splicer_filter)
-    if map_filter:
-        query = query.filter(Record.map.ilike(f"%{map_filter}%"))
-    if device_filter:
-        query = query.filter(Record.device.ilike(f"%{device_filter}%"))
-
-    if start_raw:
-        try:
-            start_dt = datetime.fromisoformat(start_raw)
-            query = query.filter(Record.created_date >= start_dt)
-        except ValueError:
-            start_dt = None
-    else:
-        start_dt = None
-
-    if end_raw:
-        try:
-            end_dt = datetime.fromisoformat(end_raw)
-            query = query.filter(Record.created_date <= end_dt)
-        except ValueError:
-            end_dt = None
-    else:
-        end_dt = None
-
-    from datetime import datetime as _dt
-    inv_date = _dt.utcnow().date().isoformat()
-    inv_number = _dt.utcnow().strftime("INV-%Y%m%d-%H%M%S")
+        raise ExportError("Para gerar invoice, selecione uma empresa específica (filtro de empresa).")
 
-    # se não for admin, força o filtro para o próprio splicer
-    if not getattr(current_user, "is_admin", False):
-        enforced_splicer = getattr(current_user, "splicer_name", None) or current_user.username
-        query = query.filter(Record.splicer == enforced_splicer)
+    start_dt, end_dt = filt.start_dt, filt.end_dt
 
-    records = query.order_by(Record.created_date.asc().nullslast(), Record.id.asc()).all()
-
-    # agrupar por mapa + dispositivo
-    grouped = {}
-    for r in records:
-        key = ((r.map or "").strip(), (r.device or "").strip())
-        if key not in grouped:
-            grouped[key] = {
-                "map": key[0] or "-",
-                "device": key[1] or "-",
-                "splices": 0,
-                "price_device_usd": float(r.price_device_usd or 0.0),
-                "total_usd": 0.0,
-            }
-        grouped[key]["splices"] += int(r.splices or 0)
-        grouped[key]["total_usd"] += float(r.total_usd or 0.0)
-        # se o preço do dispositivo vier zero mas houver total,
-        # tenta inferir um valor médio por dispositivo
-        if grouped[key]["price_device_usd"] == 0.0 and (r.total_usd or 0) and (r.splices or 0):
-            grouped[key]["price_device_usd"] = float(r.total_usd or 0.0) / float(r.splices or 1)
+    inv_date = datetime.utcnow().date().isoformat()
+    inv_number = datetime.utcnow().strftime("INV-%Y%m%d-%H%M%S")
 
-    lines = list(grouped.values())
-    lines.sort(key=lambda x: (x["map"], x["device"]))
+    # agrupar por mapa + dispositivo (GROUP BY no banco)
+    lines = invoice_lines(filt)
+    if progress:
+        progress(0.5)
 
     total_invoice = sum(l["total_usd"] for l in lines)
 
@@ -1002,6 +3088,8 @@ def export_invoice():
     # buscar dados da sua empresa (emitente)
     syscfg = SystemConfig.query.first()
 
+    from fpdf import FPDF
+
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.add_page()
@@ -1076,159 +3164,461 @@ def export_invoice():
     pdf.set_font("Arial", "B", 11)
     pdf.cell(0, 8, f"Invoice total: $ {total_invoice:.2f}", ln=1)
 
-    buf = BytesIO()
-    pdf.output(buf)
-    buf.seek(0)
-    filename = "invoice_splicer.pdf"
-    return send_file(buf, as_attachment=True, download_name=filename, mimetype="application/pdf")
+    pdf.output(out)
+    return "invoice_splicer.pdf", "application/pdf"
 
 
 
 
 
-@app.route("/export/excel")
+@bp.route("/export/excel")
 @login_required
+@read_replica
 def export_excel():
+    return send_export("excel")
+
+
+def render_excel(out, args, user, progress=None):
     """Exporta os dados de produção em formato Excel (CSV) por empresa e período.
 
     O arquivo contém: nome do mapa, nome do dispositivo e número de fusões,
     já somados por mapa/dispositivo dentro do filtro.
     """
-    company_filter = request.args.get("company") or None
-    splicer_filter = request.args.get("splicer") or None
-    map_filter = request.args.get("map") or None
-    device_filter = request.args.get("device") or None
-    start_raw = request.args.get("start") or None
-    end_raw = request.args.get("end") or None
+    filt = RecordFilter.from_args(args, user)
+    company_filter = filt.company
 
     if not company_filter:
-        flash("To export Excel, select a company in the filter.", "danger")
-        return redirect(url_for("index"))
+        raise ExportError("To export Excel, select a company in the filter.")
 
-    query = Record.query
+    stats = excel_stats(filt)
+    if not stats["rows"]:
+        raise ExportError("No records found for this filter.", "warning")
+    if progress:
+        progress(0.1)
 
-    if company_filter:
-        query = query.filter(Record.company == company_filter)
-    if splicer_filter:
-        query = query.filter(Record.splicer == splicer_filter)
-    if map_filter:
-        query = query.filter(Record.map == map_filter)
+    # agrupar por mapa + dispositivo + data (GROUP BY no banco, lido em blocos)
+    headers = ["Date", "Map", "Device", "Splices"]
+    rows = excel_daily_lines(filt)
+    footer = [
+        ["TOTAL DEVICES", stats["devices"], None, None],
+        ["TOTAL SPLICES", None, None, stats["splices"]],
+    ]
+
+    # larguras calculadas antes de escrever (no modo write-only elas vão no topo da planilha);
+    # a soma de fusões de uma linha nunca passa do total
+    widths = [
+        len("TOTAL DEVICES"),
+        max(len("Map"), stats["map_len"], len(str(stats["devices"]))),
+        max(len("Device"), stats["device_len"]),
+        max(len("Splices"), len(str(stats["splices"]))),
+    ]
+
+    write_xlsx(out, "Production", headers, rows, footer, widths)
 
-    start_dt = None
-    end_dt = None
-    if start_raw:
-        try:
-            start_dt = datetime.fromisoformat(start_raw)
-            query = query.filter(Record.created_date >= start_dt)
-        except ValueError:
-            start_dt = None
-    if end_raw:
-        try:
-            end_dt = datetime.fromisoformat(end_raw)
-            query = query.filter(Record.created_date <= end_dt)
-        except ValueError:
-            end_dt = None
+    filename = f"splicer_{company_filter or 'all'}_{datetime.utcnow().strftime('%Y%m%d')}.xlsx"
+    return filename, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
-    # se não for admin, força o filtro para o próprio splicer
-    if not getattr(current_user, "is_admin", False):
-        enforced_splicer = getattr(current_user, "splicer_name", None) or current_user.username
-        query = query.filter(Record.splicer == enforced_splicer)
 
-    records = query.order_by(Record.created_date.asc().nullslast(), Record.id.asc()).all()
+# --------- Export CSV (streaming) ---------
+CSV_EXPORT_BATCH = 2000
+CSV_EXPORT_FLUSH_BYTES = 64 * 1024
 
-    if not records:
-        flash("No records found for this filter.", "warning")
-        return redirect(url_for("index"))
 
-    # agrupar por mapa + dispositivo + data
-    grouped = {}
-    devices_unique = set()
-    for r in records:
-        map_name = (r.map or "").strip()
-        device_name = (r.device or "").strip()
-        date_value = r.created_date.date().isoformat() if r.created_date else None
-
-        key = (map_name, device_name, date_value)
-        if key not in grouped:
-            grouped[key] = {
-                "map": map_name or "-",
-                "device": device_name or "-",
-                "date": date_value or "",
-                "splices": 0,
-            }
-        grouped[key]["splices"] += int(r.splices or 0)
+def csv_export_rows(filt, no_values: bool = False):
+    """Gera o cabeçalho e as linhas do CSV lendo o banco em blocos (cursor no servidor).
 
-        if device_name:
-            devices_unique.add(device_name)
+    Só as colunas do arquivo são carregadas, nunca entidades Record inteiras.
+    """
+    cols = [Record.id, Record.created_date, Record.company, Record.splicer, Record.map,
+            Record.type, Record.device, Record.splices]
+    headers = ["Id", "Date", "Company", "Splicer", "Map", "Type", "Device", "Splices"]
+    if not no_values:
+        cols += [Record.price_splices_usd, Record.price_device_usd, Record.total_usd]
+        headers += ["Splices USD", "Device USD", "Total USD"]
 
-    lines = list(grouped.values())
-    lines.sort(key=lambda x: (x["date"], x["map"], x["device"]))
+    query = (
+        filt.apply(db.session.query(*cols))
+        .order_by(Record.created_date.desc().nullslast(), Record.id.desc())
+        .execution_options(stream_results=True)
+    )
+    yield headers
+    for r in query.yield_per(CSV_EXPORT_BATCH):
+        row = [
+            r.id,
+            r.created_date.strftime("%Y-%m-%d") if r.created_date else "",
+            r.company or "",
+            r.splicer or "",
+            r.map or "",
+            r.type or "",
+            r.device or "",
+            r.splices or 0,
+        ]
+        if not no_values:
+            row += [
+                f"{(r.price_splices_usd or 0):.2f}",
+                f"{(r.price_device_usd or 0):.2f}",
+                f"{(r.total_usd or 0):.2f}",
+            ]
+        yield row
+
+
+def iter_csv(rows, compress: bool = False):
+    """Serializa ``rows`` em CSV e devolve pedaços de ~64 KB (gzip opcional, feito na hora)."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    gz = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16) if compress else None
+
+    def drain():
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= CSV_EXPORT_FLUSH_BYTES:
+            chunk = drain()
+            if chunk:
+                yield chunk
+    chunk = drain()
+    if gz:
+        chunk += gz.flush()
+    if chunk:
+        yield chunk
+
+
+@bp.route("/export/csv")
+@login_required
+@read_replica
+def export_csv():
+    """CSV linha a linha com os filtros da tela principal (integração contábil).
 
-    # gerar planilha Excel (XLSX) em memória
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Production"
+    A resposta é gerada enquanto o banco é lido, então o servidor nunca monta
+    o arquivo inteiro. ``gzip=1`` envia um .csv.gz comprimido na hora.
+    """
+    filt = RecordFilter.from_args(request.args, current_user)
+    no_values = request.args.get("no_values") == "1"
+    compress = request.args.get("gzip") == "1"
 
-    # cabeçalho (Date | Map | Device | Splices)
-    headers = ["Date", "Map", "Device", "Splices"]
-    ws.append(headers)
-
-    # linhas de dados
-    total_splices = 0
-    for line in lines:
-        ws.append([line["date"], line["map"], line["device"], line["splices"]])
-        total_splices += int(line["splices"] or 0)
-
-    # linhas de totais
-    total_devices = len(devices_unique)
-    ws.append([])
-    total_row_devices = ws.max_row + 1
-    ws.cell(row=total_row_devices, column=1, value="TOTAL DEVICES")
-    ws.cell(row=total_row_devices, column=2, value=total_devices)
-
-    total_row_splices = total_row_devices + 1
-    ws.cell(row=total_row_splices, column=1, value="TOTAL SPLICES")
-    ws.cell(row=total_row_splices, column=4, value=total_splices)
-
-    # aplicar estilos (negrito cabeçalho e totais, bordas)
-    thin = Side(border_style="thin", color="000000")
-    border = Border(top=thin, left=thin, right=thin, bottom=thin)
+    company = "".join(ch for ch in (filt.company or "all") if ch.isprintable())
+    filename = f"splicer_{company}_{datetime.utcnow().strftime('%Y%m%d')}.csv"
+    if compress:
+        filename += ".gz"
+    body = stream_with_context(iter_csv(csv_export_rows(filt, no_values), compress))
+    resp = Response(body, mimetype="application/gzip" if compress else "text/csv")
+    resp.headers.set("Content-Disposition", "attachment", **attachment_filename(filename))
+    return resp
 
-    # cabeçalho em negrito
-    for col in range(1, len(headers) + 1):
-        cell = ws.cell(row=1, column=col)
-        cell.font = Font(bold=True)
-        cell.border = border
-
-    # dados + bordas
-    last_row = total_row_splices
-    for row in range(2, last_row + 1):
-        for col in range(1, 5):
-            cell = ws.cell(row=row, column=col)
-            # destacar totais
-            if row in (total_row_devices, total_row_splices):
-                cell.font = Font(bold=True)
-            cell.border = border
-
-    # autoajustar largura das colunas
-    for col in range(1, 5):
-        max_len = 0
-        col_letter = ws.cell(row=1, column=col).column_letter
-        for row in range(1, last_row + 1):
-            val = ws.cell(row=row, column=col).value
-            if val is None:
-                continue
-            max_len = max(max_len, len(str(val)))
-        ws.column_dimensions[col_letter].width = max_len + 2
 
-    buf = BytesIO()
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
+def attachment_filename(filename: str) -> dict:
+    """Parâmetros de Content-Disposition como o send_file(download_name=...) monta.
 
-    filename = f"splicer_{company_filter or 'all'}_{datetime.utcnow().strftime('%Y%m%d')}.xlsx"
-    return send_file(buf, as_attachment=True, download_name=filename, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-@app.route("/record/<int:rid>/delete")
+    O Werkzeug escapa aspas e barras no valor; nomes fora do ASCII vão também
+    em ``filename*`` (RFC 5987), com uma versão ASCII em ``filename``.
+    """
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": f"UTF-8''{url_quote(filename, safe='!#$&+^`|~')}"}
+    return {"filename": filename}
+
+
+# --------- Exports em segundo plano ---------
+EXPORT_RENDERERS = {
+    "pdf": render_pdf_report,
+    "invoice": render_invoice,
+    "excel": render_excel,
+}
+
+
+def reprice_summary(report: dict, dry_run: bool) -> str:
+    return (
+        ("Simulação: " if dry_run else "Reprecificação concluída: ")
+        + f"{report['rows']} lançamentos lidos, {report['changed']} alterados, "
+        + f"total $ {report['total_before']:.2f} → $ {report['total_after']:.2f} "
+        + f"(diferença $ {report['delta']:.2f}), {report['rows_per_sec']:.0f} linhas/s."
+    )
+
+
+def render_reprice_report(out, args, user, progress=None):
+    """Reprecificação pela fila de jobs (milhões de linhas não cabem numa requisição).
+
+    O "arquivo" do job é o resumo em texto; cada bloco já foi gravado com o
+    rollup, então um job interrompido deixa preços e totais consistentes.
+    """
+    if not getattr(user, "is_admin", False):
+        raise ExportError("Só administradores podem reprecificar lançamentos.")
+    company = args.get("company") or None
+    dry_run = args.get("dry_run") == "1"
+    report = reprice_records(
+        company,
+        datetime.fromisoformat(args["start"]) if args.get("start") else None,
+        datetime.fromisoformat(args["end"]) if args.get("end") else None,
+        dry_run=dry_run,
+        progress=progress,
+    )
+    out.write((reprice_summary(report, dry_run) + "\n").encode("utf-8"))
+    return f"reprecificacao_{company or 'todas'}_{datetime.utcnow().strftime('%Y%m%d')}.txt", "text/plain"
+
+
+# jobs da fila: os exports (abertos a todos em /export/jobs) e a reprecificação (só pelas configurações)
+JOB_RUNNERS = {**EXPORT_RENDERERS, "reprice": render_reprice_report}
+EXPORT_EXTENSIONS = {"pdf": "pdf", "invoice": "pdf", "excel": "xlsx", "reprice": "txt"}
+# parâmetros aceitos pelos exports (filtros da tela principal + variante sem valores)
+EXPORT_PARAMS = ("company", "splicer", "map", "device", "start", "end", "no_values")
+
+_export_pool = None
+
+
+def export_pool() -> ProcessPoolExecutor:
+    """Pool de processos do worker (criado no primeiro uso; "spawn" não herda conexões abertas)."""
+    global _export_pool
+    if _export_pool is None:
+        _export_pool = ProcessPoolExecutor(
+            max_workers=current_app.config["EXPORT_WORKERS"],
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _export_pool
+
+
+# jobs que este processo entregou ao pool e que ainda não terminaram (heartbeat)
+_pool_jobs = set()
+_pool_jobs_lock = threading.Lock()
+_heartbeat_pid = None
+
+
+def dispatch_export_job(job_id: int):
+    db.session.execute(update(ExportJob).where(ExportJob.id == job_id).values(dispatched_at=datetime.utcnow()))
+    db.session.commit()
+    if current_app.config["EXPORT_WORKERS"] > 0:
+        job_app = current_app._get_current_object()
+        start_export_heartbeat(job_app)
+        with _pool_jobs_lock:
+            _pool_jobs.add(job_id)
+        future = export_pool().submit(run_export_job, job_id)
+        future.add_done_callback(lambda f: export_job_done(job_app, job_id, f))
+    else:
+        run_export_job(job_id)
+
+
+def start_export_heartbeat(job_app):
+    """Thread (uma por processo) que renova dispatched_at dos jobs ainda esperando no pool.
+
+    Um job atrás de um pool ocupado continua com heartbeat e não é redespachado;
+    se o processo dono morre, o heartbeat para e recover_export_jobs o devolve.
+    """
+    global _heartbeat_pid
+    if _heartbeat_pid == os.getpid():
+        return
+    _heartbeat_pid = os.getpid()
+    interval = max(job_app.config["EXPORT_REQUEUE_AFTER"] / 3, 1)
+
+    def beat():
+        while True:
+            time.sleep(interval)
+            with job_app.app_context():
+                try:
+                    beat_export_jobs()
+                except Exception:
+                    db.session.rollback()
+                    job_app.logger.exception("heartbeat dos exports falhou")
+
+    threading.Thread(target=beat, name="export-heartbeat", daemon=True).start()
+
+
+def beat_export_jobs() -> int:
+    """Renova dispatched_at dos jobs deste processo que ainda estão na fila do pool."""
+    with _pool_jobs_lock:
+        job_ids = list(_pool_jobs)
+    if not job_ids:
+        return 0
+    beaten = db.session.execute(
+        update(ExportJob)
+        .where(ExportJob.id.in_(job_ids), ExportJob.status == "queued")
+        .values(dispatched_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return beaten
+
+
+def export_job_done(job_app, job_id: int, future):
+    """Callback do pool: se o processo filho morreu, marca o job como falho na hora."""
+    global _export_pool
+    with _pool_jobs_lock:
+        _pool_jobs.discard(job_id)
+    if future.cancelled() or future.exception() is None:
+        return
+    if isinstance(future.exception(), BrokenProcessPool):
+        # pool quebrado não aceita mais nada; o próximo export cria outro
+        _export_pool = None
+    with job_app.app_context():
+        db.session.execute(
+            update(ExportJob)
+            .where(ExportJob.id == job_id, ExportJob.status.in_(("queued", "running")))
+            .values(status="failed", error="O processo do export foi encerrado. Gere novamente.",
+                    finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+
+
+def recover_export_jobs() -> tuple[int, list[int]]:
+    """Trata jobs perdidos: falha os "running" presos e devolve os "queued" esquecidos.
+
+    Um "queued" fica sem dono quando o worker do gunicorn reinicia antes do pool
+    pegar o job (o heartbeat em dispatched_at para); um "running" fica preso
+    quando o processo filho morre. Retorna (quantos falharam, ids para despachar
+    de novo). Cada id devolvido já foi reivindicado com um UPDATE condicional,
+    então só um worker o redespacha; o claim em run_export_job garante que ele
+    não roda duas vezes.
+    """
+    now = datetime.utcnow()
+    timeout = timedelta(seconds=current_app.config["EXPORT_JOB_TIMEOUT"])
+    failed = db.session.execute(
+        update(ExportJob)
+        .where(ExportJob.status == "running", ExportJob.started_at < now - timeout)
+        .values(status="failed", error="O export passou do tempo limite ou foi interrompido. Gere novamente.",
+                finished_at=now)
+    ).rowcount
+    db.session.commit()
+    requeue_before = now - timedelta(seconds=current_app.config["EXPORT_REQUEUE_AFTER"])
+    stale = (
+        ExportJob.status == "queued",
+        func.coalesce(ExportJob.dispatched_at, ExportJob.created_at) < requeue_before,
+    )
+    lost = []
+    for (jid,) in db.session.query(ExportJob.id).filter(*stale).order_by(ExportJob.id).all():
+        claimed = db.session.execute(
+            update(ExportJob).where(ExportJob.id == jid, *stale).values(dispatched_at=now)
+        ).rowcount
+        if claimed:
+            lost.append(jid)
+    db.session.commit()
+    return failed, lost
+
+
+def run_export_job(job_id: int):
+    """Executa um job da fila: gera o arquivo em EXPORT_DIR e atualiza o status."""
+    # no pool ("spawn") não há app ativo: usa o app do módulo, montado pelo ambiente
+    job_app = current_app._get_current_object() if has_app_context() else app
+    with job_app.app_context():
+        # só um processo consegue passar o job de queued para running
+        claimed = db.session.execute(
+            update(ExportJob)
+            .where(ExportJob.id == job_id, ExportJob.status == "queued")
+            .values(status="running", started_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+
+        job = db.session.get(ExportJob, job_id)
+        user = db.session.get(User, job.user_id)
+        os.makedirs(current_app.config["EXPORT_DIR"], exist_ok=True)
+        path = os.path.join(
+            current_app.config["EXPORT_DIR"], f"{job.id}-{uuid.uuid4().hex}.{EXPORT_EXTENSIONS[job.kind]}"
+        )
+
+        def progress(fraction):
+            job.progress = int(fraction * 100)
+            db.session.commit()
+
+        try:
+            if user is None:
+                raise ExportError("Usuário do export não existe mais.")
+            with open(path, "wb") as out:
+                filename, mimetype = JOB_RUNNERS[job.kind](out, json.loads(job.params or "{}"), user, progress)
+        except Exception as exc:
+            db.session.rollback()
+            if os.path.exists(path):
+                os.remove(path)
+            job.status = "failed"
+            job.error = str(exc) or exc.__class__.__name__
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            return
+
+        now = datetime.utcnow()
+        job.status = "done"
+        job.progress = 100
+        job.file_path = path
+        job.download_name = filename
+        job.mimetype = mimetype
+        job.finished_at = now
+        job.expires_at = now + timedelta(seconds=current_app.config["EXPORT_TTL"])
+        db.session.commit()
+
+
+def purge_expired_exports() -> int:
+    """Remove jobs vencidos e seus arquivos."""
+    expired = ExportJob.query.filter(ExportJob.expires_at < datetime.utcnow()).all()
+    for job in expired:
+        if job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+        db.session.delete(job)
+    db.session.commit()
+    return len(expired)
+
+
+def _own_export_job(jid: int) -> "ExportJob":
+    job = ExportJob.query.get_or_404(jid)
+    if job.user_id != current_user.id and not getattr(current_user, "is_admin", False):
+        abort(404)
+    return job
+
+
+@bp.route("/export/jobs", methods=["POST"])
+@login_required
+def export_job_create():
+    """Coloca um export na fila e devolve a URL de status para a tela consultar."""
+    kind = request.form.get("kind") or ""
+    if kind not in EXPORT_RENDERERS:
+        abort(400)
+    params = {k: request.form.get(k) for k in EXPORT_PARAMS if request.form.get(k)}
+
+    purge_expired_exports()
+    job = ExportJob(
+        kind=kind,
+        params=json.dumps(params),
+        user_id=current_user.id,
+        expires_at=datetime.utcnow() + timedelta(seconds=current_app.config["EXPORT_TTL"]),
+    )
+    db.session.add(job)
+    db.session.commit()
+    dispatch_export_job(job.id)
+    return jsonify(id=job.id, status_url=url_for("main.export_job_status", jid=job.id)), 202
+
+
+@bp.route("/export/jobs/<int:jid>")
+@login_required
+def export_job_status(jid: int):
+    job = _own_export_job(jid)
+    if job.status in ("queued", "running"):
+        # a própria consulta da tela recupera jobs perdidos (não depende de cron)
+        _, lost = recover_export_jobs()
+        for lost_id in lost:
+            dispatch_export_job(lost_id)
+        db.session.refresh(job)
+    return jsonify(
+        id=job.id,
+        kind=job.kind,
+        status=job.status,
+        progress=job.progress or 0,
+        error=job.error,
+        download_url=url_for("main.export_job_download", jid=job.id) if job.status == "done" else None,
+    )
+
+
+@bp.route("/export/jobs/<int:jid>/download")
+@login_required
+def export_job_download(jid: int):
+    job = _own_export_job(jid)
+    if job.status != "done" or not job.file_path or not os.path.exists(job.file_path):
+        flash("Arquivo não disponível (ainda em processamento ou expirado).", "warning")
+        return redirect(url_for("main.index"))
+    return send_file(job.file_path, as_attachment=True, download_name=job.download_name, mimetype=job.mimetype)
+
+@bp.route("/record/<int:rid>/delete")
 @login_required
 def record_delete(rid: int):
     rec = Record.query.get_or_404(rid)
@@ -1236,7 +3626,7 @@ def record_delete(rid: int):
     # Apenas admin ou o próprio splicer podem editar
     if not getattr(current_user, "is_admin", False) and rec.splicer != current_user.username:
         flash("Você não tem permissão para editar este lançamento.", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
     # Apenas admin pode apagar qualquer registro.
     # Usuário comum só pode apagar o próprio lançamento.
@@ -1245,10 +3635,148 @@ def record_delete(rid: int):
         if rec.splicer != enforced_splicer:
             abort(403)
 
+    rollup_apply(rec, -1)
+    release_fingerprint(rec)
     db.session.delete(rec)
     db.session.commit()
     flash("Registro removido.", "success")
-    return redirect(url_for("index"))
+    return redirect(url_for("main.index"))
+
+# --------- Comandos CLI ---------
+@bp.cli.command("reprice")
+@click.option("--company", default=None, help="Empresa (vazio = todas).")
+@click.option("--start", default=None, help="Data inicial (YYYY-MM-DD).")
+@click.option("--end", default=None, help="Data final (YYYY-MM-DD).")
+@click.option("--chunk-size", default=2000, show_default=True)
+@click.option("--dry-run", is_flag=True, help="Só calcula a diferença, sem gravar.")
+def reprice_command(company, start, end, chunk_size, dry_run):
+    """Recalcula os valores dos lançamentos com a tabela de preços atual."""
+    report = reprice_records(
+        company,
+        datetime.fromisoformat(start) if start else None,
+        datetime.fromisoformat(end) if end else None,
+        chunk_size=chunk_size,
+        dry_run=dry_run,
+    )
+    click.echo(
+        f"{report['rows']} lidos, {report['changed']} alterados, "
+        f"total {report['total_before']:.2f} -> {report['total_after']:.2f} "
+        f"(diferença {report['delta']:.2f}), {report['rows_per_sec']:.0f} linhas/s"
+        + (" [simulação]" if dry_run else "")
+    )
+
+
+@bp.cli.command("export-worker")
+def export_worker_command():
+    """Processa os exports que ficaram na fila e apaga os vencidos.
+
+    Opcional: a tela de status já redespacha jobs perdidos. Se agendar, rode no
+    mesmo host do web, porque os arquivos ficam no disco local (EXPORT_DIR).
+    """
+    purged = purge_expired_exports()
+    failed, _ = recover_export_jobs()
+    job_ids = [j.id for j in ExportJob.query.filter_by(status="queued").order_by(ExportJob.id).all()]
+    for job_id in job_ids:
+        run_export_job(job_id)
+    click.echo(f"{len(job_ids)} exports processados, {failed} presos marcados como falhos, {purged} vencidos removidos")
+
+
+@bp.cli.command("import-records")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--splicer", default="ADMIN", show_default=True, help="Splicer para linhas sem a coluna Splicer")
+@click.option("--dry-run", is_flag=True, help="Só valida e mostra o relatório, sem gravar")
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True)
+def import_records_command(path, splicer, dry_run, chunk_size):
+    """Importa uma planilha de produção (.xlsx / .csv) direto do servidor."""
+    with open(path, "rb") as stream:
+        report = import_records(stream, path, splicer, dry_run=dry_run, chunk_size=chunk_size)
+    for error in report.pop("errors"):
+        click.echo(error, err=True)
+    click.echo(json.dumps(report, indent=2))
+
+
+@bp.cli.command("migrate")
+def migrate_command():
+    """Aplica as migrações de schema pendentes (uma vez, sob lock)."""
+    applied = migrate_schema()
+    click.echo(f"schema na versão {schema_version()} ({len(applied)} passos aplicados)")
+
+
+@bp.cli.command("rebuild-rollup")
+@click.option("--company", default=None, help="Empresa (vazio = todas).")
+@click.option("--start", default=None, help="Data inicial (YYYY-MM-DD).")
+@click.option("--end", default=None, help="Data final (YYYY-MM-DD).")
+def rebuild_rollup_command(company, start, end):
+    """Recalcula a tabela record_daily_rollup a partir dos lançamentos."""
+    rows = rebuild_rollup(
+        company,
+        datetime.fromisoformat(start) if start else None,
+        datetime.fromisoformat(end) if end else None,
+    )
+    click.echo(f"{rows} linhas de rollup gravadas")
+
+
+@bp.cli.command("bench-filter")
+@click.option("--company", default=None)
+@click.option("--splicer", default=None)
+@click.option("--map", "map_", default=None)
+@click.option("--device", default=None)
+@click.option("--start", default=None, help="YYYY-MM-DD")
+@click.option("--end", default=None, help="YYYY-MM-DD")
+@click.option("--repeat", default=5, show_default=True)
+def bench_filter_command(company, splicer, map_, device, start, end, repeat):
+    """Mede o tempo das consultas da tela principal para um filtro (visão de admin)."""
+    filt = RecordFilter(company=company, splicer=splicer, map=map_, device=device, start=start, end=end)
+    per_page = current_app.config["RECORDS_PER_PAGE"]
+    click.echo(f"filtro {filt.to_args()}")
+    for label, run in (
+        ("totais", lambda: filter_totals(filt)),
+        ("1a página", lambda: paginate_records(filt.query(), per_page=per_page)),
+    ):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - started) * 1000)
+            db.session.rollback()
+        click.echo(f"{label}: melhor {min(timings):.1f} ms, média {sum(timings) / len(timings):.1f} ms")
+
+
+
+STARTUP_BENCH_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import app as splicer_app
+t1 = time.perf_counter()
+client = splicer_app.app.test_client()
+status = client.get("/login").status_code
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "first_request": t2 - t1, "status": status,
+                  "heavy": sorted(m for m in ("fpdf", "openpyxl") if m in sys.modules)}))
+"""
+
+
+@bp.cli.command("bench-startup")
+@click.option("--repeat", default=5, show_default=True)
+def bench_startup_command(repeat):
+    """Mede, em processos novos, o tempo de import do app e do primeiro request."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_BENCH_SCRIPT],
+            cwd=root, capture_output=True, text=True, check=True,
+        ).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    for label in ("import", "first_request"):
+        timings = [r[label] * 1000 for r in runs]
+        click.echo(f"{label}: melhor {min(timings):.1f} ms, média {sum(timings) / len(timings):.1f} ms")
+    click.echo(f"libs de export carregadas no boot: {', '.join(runs[-1]['heavy']) or 'nenhuma'}")
+
+
+# app padrão (gunicorn app:app, flask --app app); sem conexão com o banco nem libs de export,
+# então é seguro para `gunicorn --preload`
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True)
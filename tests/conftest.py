@@ -0,0 +1,56 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as splicer  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """App novo por teste, num SQLite temporário já migrado."""
+    app = splicer.create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+        "EXPORT_WORKERS": 0,
+        "EXPORT_DIR": str(tmp_path / "exports"),
+    })
+    with app.app_context():
+        splicer.migrate_schema()
+    yield app
+    with app.app_context():
+        splicer.db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin"})
+    return client
+
+
+def seed_records(count: int, companies=("ACME", "NORTE"), splicers=("ANA", "BETO"), chunk: int = 20000):
+    """Grava `count` lançamentos sintéticos em blocos (sem passar pelo ORM) e monta o rollup."""
+    start = datetime(2026, 1, 1)
+    for offset in range(0, count, chunk):
+        rows = []
+        for i in range(offset, min(offset + chunk, count)):
+            rows.append({
+                "company": companies[i % len(companies)],
+                "splicer": splicers[i % len(splicers)],
+                "map": f"MAP-{i % 500}",
+                "device": f"CTO-{i}",
+                "type": "HUB" if i % 10 == 0 else "CTO",
+                "splices": 12,
+                "created_date": start + timedelta(hours=i % 2000),
+                "price_splices_usd": 1.5,
+                "price_device_usd": 10.0,
+                "total_usd": 11.5,
+            })
+        splicer.db.session.execute(insert(splicer.Record.__table__), rows)
+        splicer.db.session.commit()
+    splicer.rebuild_rollup()
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+import app as splicer
+from conftest import seed_records
+
+WRITERS = 3
+ROWS = 10
+STREAMERS = 2
+READERS = 2
+# acima da espera entre escritores (centenas de ms no pior caso), abaixo de um export lento
+BUSY_TIMEOUT_MS = 1000
+
+
+@pytest.fixture
+def contended_app(tmp_path, monkeypatch, request):
+    """App num SQLite em arquivo com o modo de journal do parâmetro e busy_timeout curto."""
+    monkeypatch.setenv("SQLITE_MODE", request.param)
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT_MS", str(BUSY_TIMEOUT_MS))
+    app = splicer.create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+        # vale também sem os PRAGMAs (modo "default"): o sqlite3 do Python esperaria 5 s
+        "SQLALCHEMY_ENGINE_OPTIONS": {"connect_args": {"timeout": BUSY_TIMEOUT_MS / 1000}},
+        "EXPORT_WORKERS": 0,
+    })
+    with app.app_context():
+        splicer.migrate_schema()
+        seed_records(4000)
+    yield app
+    with app.app_context():
+        splicer.db.engine.dispose()
+
+
+def run_contention(app):
+    """Escritores (lançamento em lote) contra leitores: exports em CSV lidos devagar e totais + 1a página.
+
+    Um export em andamento mantém a leitura aberta por ~2.5 s, bem mais que o
+    busy_timeout; os escritores precisam gravar enquanto isso.
+    """
+    errors, done = [], threading.Event()
+    reads = [0]
+    filt = splicer.RecordFilter(company="ACME")
+
+    def writer(n):
+        with app.app_context():
+            for i in range(ROWS):
+                try:
+                    splicer.save_entry_batch([{
+                        "company": "ACME", "map": f"W{n}", "type": "", "device_name": f"D{i}", "splices": 1,
+                    }], "ANA")
+                except Exception as exc:
+                    splicer.db.session.rollback()
+                    errors.append(f"escrita: {exc}")
+                time.sleep(0.01)
+
+    def streamer():
+        with app.app_context():
+            while not done.is_set():
+                try:
+                    for i, _ in enumerate(splicer.csv_export_rows(filt)):
+                        if i % 200 == 0:
+                            time.sleep(0.25)  # cliente lento baixando o arquivo (~2.5 s por export)
+                    reads[0] += 1
+                except Exception as exc:
+                    errors.append(f"export: {exc}")
+                finally:
+                    splicer.db.session.rollback()
+
+    def reader():
+        with app.app_context():
+            while not done.is_set():
+                try:
+                    splicer.filter_totals(filt)
+                    splicer.paginate_records(filt.query(), per_page=50)
+                    reads[0] += 1
+                except Exception as exc:
+                    errors.append(f"leitura: {exc}")
+                finally:
+                    splicer.db.session.rollback()
+
+    read_threads = [threading.Thread(target=streamer) for _ in range(STREAMERS)]
+    read_threads += [threading.Thread(target=reader) for _ in range(READERS)]
+    write_threads = [threading.Thread(target=writer, args=(n,)) for n in range(WRITERS)]
+    for t in read_threads + write_threads:
+        t.start()
+    for t in write_threads:
+        t.join()
+    done.set()
+    for t in read_threads:
+        t.join()
+    return errors, reads[0]
+
+
+@pytest.mark.parametrize("contended_app", ["wal"], indirect=True)
+def test_wal_lets_writers_commit_during_long_reads(contended_app):
+    errors, reads = run_contention(contended_app)
+    assert errors == []
+    assert reads > 0
+    with contended_app.app_context():
+        totals = splicer.filter_totals(splicer.RecordFilter(company="ACME"))
+    # o rollup acompanhou todas as escritas concorrentes (ACME tem metade dos 4000 semeados)
+    assert totals["rows"] == 2000 + WRITERS * ROWS
+
+
+@pytest.mark.parametrize("contended_app", ["default"], indirect=True)
+def test_rollback_journal_locks_writers_out(contended_app):
+    # mesmo cenário sem WAL: o commit precisa que as leituras abertas terminem
+    errors, _ = run_contention(contended_app)
+    assert any("database is locked" in error for error in errors)
@@ -0,0 +1,25 @@
+import app as splicer
+
+
+def dimensions(app):
+    with app.app_context():
+        dims = splicer.get_dimensions()
+        return dims.companies, dims.splicers
+
+
+def test_deleted_company_leaves_the_filter_lists(app, client):
+    row = {"company": "ZETA", "map": "M1", "device_name": "CTO-1", "splices": 4, "splicer": "ZE"}
+    saved = client.post("/entry/batch", json={"rows": [row]}).get_json()["results"][0]
+    assert saved["status"] == "saved"
+    companies, splicers = dimensions(app)
+    assert "ZETA" in companies and "ZE" in splicers
+
+    client.get(f"/record/{saved['id']}/delete")
+    companies, splicers = dimensions(app)
+    assert "ZETA" not in companies
+    assert "ZE" not in splicers
+
+    # voltou a ter lançamento na mesma linha (zerada) do rollup
+    client.post("/entry/batch", json={"rows": [row]})
+    companies, _ = dimensions(app)
+    assert "ZETA" in companies
@@ -0,0 +1,17 @@
+import app as splicer
+
+
+def test_batch_accepts_rows_without_company_like_single_entry(app, client):
+    client.post("/entry", data={"map": "M1", "device_name": "CTO-1", "splices": "2"})
+    result = client.post("/entry/batch", json={"rows": [{"map": "M1", "device_name": "CTO-2", "splices": 3}]})
+    assert result.get_json()["results"][0]["status"] == "saved"
+    with app.app_context():
+        assert splicer.Record.query.filter(splicer.Record.company.is_(None)).count() == 2
+
+
+def test_map_is_required_in_both_paths(app, client):
+    client.post("/entry", data={"company": "ACME", "device_name": "CTO-1", "splices": "2"})
+    result = client.post("/entry/batch", json={"rows": [{"company": "ACME", "device_name": "CTO-2", "type": "CTO"}]})
+    assert result.get_json()["results"][0]["status"] == "error"
+    with app.app_context():
+        assert splicer.Record.query.count() == 0
@@ -0,0 +1,27 @@
+from werkzeug.http import parse_options_header
+
+
+def disposition(client, company):
+    result = client.get("/export/csv", query_string={"company": company})
+    assert result.status_code == 200
+    return parse_options_header(result.headers["Content-Disposition"])
+
+
+def test_filename_with_quotes_is_escaped(client):
+    kind, params = disposition(client, 'A"B; x=1')
+    assert kind == "attachment"
+    assert params["filename"].startswith('splicer_A"B; x=1_')
+    assert set(params) == {"filename"}
+
+
+def test_non_ascii_company_gets_rfc5987_filename(client):
+    header = client.get("/export/csv", query_string={"company": "Conexão"}).headers["Content-Disposition"]
+    assert header.startswith("attachment; filename=splicer_Conexao_")
+    assert "filename*=UTF-8''splicer_Conex%C3%A3o_" in header
+    # o parser prefere o filename* (nome original)
+    assert parse_options_header(header)[1]["filename"].startswith("splicer_Conexão_")
+
+
+def test_control_characters_are_dropped(client):
+    _, params = disposition(client, "ACME\r\nX-Injected: 1")
+    assert params["filename"].startswith("splicer_ACMEX-Injected: 1_")
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import app as splicer
+
+
+def make_job(app, **values):
+    with app.app_context():
+        job = splicer.ExportJob(kind="pdf", params="{}", user_id=1, **values)
+        splicer.db.session.add(job)
+        splicer.db.session.commit()
+        return job.id
+
+
+def job_status(app, jid):
+    with app.app_context():
+        return splicer.db.session.get(splicer.ExportJob, jid).status
+
+
+def test_stuck_running_job_fails_on_poll(app, client):
+    jid = make_job(app, status="running", started_at=datetime.utcnow() - timedelta(hours=2))
+    body = client.get(f"/export/jobs/{jid}").get_json()
+    assert body["status"] == "failed"
+    assert body["error"]
+
+
+def test_recent_running_job_is_left_alone(app, client):
+    jid = make_job(app, status="running", started_at=datetime.utcnow())
+    assert client.get(f"/export/jobs/{jid}").get_json()["status"] == "running"
+
+
+def test_orphaned_queued_job_is_dispatched_again(app, client):
+    jid = make_job(app, status="queued", created_at=datetime.utcnow() - timedelta(minutes=10))
+    body = client.get(f"/export/jobs/{jid}").get_json()
+    assert body["status"] == "done"
+    assert body["download_url"]
+
+
+def test_fresh_queued_job_is_not_redispatched(app, client):
+    jid = make_job(app, status="queued")
+    client.get(f"/export/jobs/{jid}")
+    assert job_status(app, jid) == "queued"
+
+
+def test_dead_pool_process_marks_job_failed(app):
+    class DeadFuture:
+        def cancelled(self):
+            return False
+
+        def exception(self):
+            return splicer.BrokenProcessPool("filho morreu")
+
+    jid = make_job(app, status="running", started_at=datetime.utcnow())
+    splicer.export_job_done(app, jid, DeadFuture())
+    assert job_status(app, jid) == "failed"
+
+
+def test_queued_job_with_live_heartbeat_is_not_redispatched(app, client):
+    # esperando atrás de um pool ocupado: criado há tempo, mas o dono ainda renova o heartbeat
+    jid = make_job(app, status="queued", created_at=datetime.utcnow() - timedelta(minutes=10),
+                   dispatched_at=datetime.utcnow())
+    client.get(f"/export/jobs/{jid}")
+    assert job_status(app, jid) == "queued"
+
+
+def test_stale_job_is_claimed_by_one_poller_only(app):
+    jid = make_job(app, status="queued", created_at=datetime.utcnow() - timedelta(minutes=10),
+                   dispatched_at=datetime.utcnow() - timedelta(minutes=5))
+    with app.app_context():
+        assert splicer.recover_export_jobs() == (0, [jid])
+        # o próximo poll (outro worker do gunicorn) vê o heartbeat novo
+        assert splicer.recover_export_jobs() == (0, [])
+
+
+def test_heartbeat_renews_only_this_process_queued_jobs(app):
+    old = datetime.utcnow() - timedelta(minutes=5)
+    mine = make_job(app, status="queued", dispatched_at=old)
+    other = make_job(app, status="queued", dispatched_at=old)
+    splicer._pool_jobs.add(mine)
+    try:
+        with app.app_context():
+            assert splicer.beat_export_jobs() == 1
+            assert splicer.recover_export_jobs() == (0, [other])
+    finally:
+        splicer._pool_jobs.discard(mine)
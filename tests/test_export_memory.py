@@ -0,0 +1,68 @@
+"""Pico de memória dos exports (tracemalloc) num SQLite temporário.
+
+O teste de CSV usa 50 mil linhas; ``SPLICER_MEMORY_ROWS=500000`` roda o volume
+completo (~4 min sob tracemalloc).
+"""
+import io
+import os
+import tracemalloc
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import app as splicer
+from conftest import seed_records
+
+CSV_ROWS = int(os.environ.get("SPLICER_MEMORY_ROWS", 50_000))
+# o pico não depende do volume (~3.3 MB com 50 mil e com 500 mil linhas); carregar
+# tudo de uma vez passa de 35 MB já com 50 mil
+CSV_PEAK_BUDGET = 8 * 1024 * 1024
+# o FPDF guarda o documento inteiro até o output(): o orçamento vale só para o
+# que o relatório segura fora dele (linhas lidas, entidades, listas)
+PDF_ROWS = 3000
+PDF_HELD_BUDGET = 1024 * 1024
+
+
+@pytest.fixture
+def admin(app):
+    with app.app_context():
+        yield splicer.User.query.filter_by(username="admin").one()
+
+
+def test_csv_export_peak_memory_is_flat(app, admin):
+    with app.test_request_context():
+        seed_records(CSV_ROWS)
+        filt = splicer.RecordFilter.from_args(MultiDict(), admin)
+        tracemalloc.start()
+        try:
+            lines = sum(chunk.count(b"\n") for chunk in splicer.iter_csv(splicer.csv_export_rows(filt), False))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    assert lines == CSV_ROWS + 1
+    assert peak < CSV_PEAK_BUDGET, f"pico de {peak / 1e6:.1f} MB para {CSV_ROWS} linhas"
+
+
+def test_pdf_report_does_not_hold_rows(app, admin):
+    import fpdf  # noqa: F401  (import e fontes fora da medição)
+
+    held = {}
+
+    def progress(fraction):
+        if fraction == 0.9:  # todas as linhas já passaram, antes do output()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, "*/fpdf/*"),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            held["bytes"] = sum(stat.size for stat in snapshot.statistics("filename"))
+
+    with app.test_request_context():
+        seed_records(PDF_ROWS)
+        out = io.BytesIO()
+        tracemalloc.start()
+        try:
+            splicer.render_pdf_report(out, MultiDict(), admin, progress)
+        finally:
+            tracemalloc.stop()
+    assert out.getvalue().startswith(b"%PDF")
+    assert held["bytes"] < PDF_HELD_BUDGET, f"{held['bytes'] / 1e6:.1f} MB fora do FPDF"
@@ -0,0 +1,70 @@
+import app as splicer
+
+
+def records(app):
+    with app.app_context():
+        return {r.id: r.fingerprint for r in splicer.Record.query.order_by(splicer.Record.id)}
+
+
+def test_confirmed_duplicate_with_other_casing_inherits_key_on_delete(app, client):
+    client.post("/entry", data={"company": "ACME", "map": "M1", "device_name": "cto-1", "splices": "2"})
+    client.post("/entry", data={"company": "acme ", "map": "m1", "device_name": "CTO-1", "splices": "2",
+                                "confirm_duplicate": "yes"})
+    (original, duplicate) = records(app)
+    fp = splicer.record_fingerprint("ACME", "M1", "cto-1")
+    assert records(app) == {original: fp, duplicate: None}
+
+    client.get(f"/record/{original}/delete")
+    assert records(app) == {duplicate: fp}
+
+    # o próximo lançamento com a mesma chave ainda é avisado
+    client.post("/entry", data={"company": "ACME", "map": "M1", "device_name": "cto-1", "splices": "2"})
+    assert list(records(app)) == [duplicate]
+
+
+def test_edit_onto_taken_key_stores_null_instead_of_failing(app, client):
+    client.post("/entry", data={"company": "ACME", "map": "M1", "device_name": "CTO-1", "splices": "2"})
+    client.post("/entry", data={"company": "ACME", "map": "M1", "device_name": "CTO-2", "splices": "2"})
+    (first, second) = records(app)
+
+    result = client.post(f"/record/{second}/edit", data={"company": "ACME", "map": "m1", "device_name": "cto-1",
+                                                         "splices": "3", "created": "2026-01-02"})
+    assert result.status_code == 302
+    assert records(app) == {first: splicer.record_fingerprint("ACME", "M1", "CTO-1"), second: None}
+
+
+def test_claim_loses_race_without_aborting_transaction(app):
+    with app.app_context():
+        holder = splicer.Record(map="M1", device="CTO-1", splices=1, splicer="ANA")
+        other = splicer.Record(map="M1", device="CTO-2", splices=1, splicer="ANA")
+        splicer.db.session.add_all([holder, other])
+        splicer.db.session.flush()
+        fp = splicer.record_fingerprint(None, "M1", "CTO-1")
+        assert splicer.claim_fingerprint(holder, fp)
+        assert not splicer.claim_fingerprint(other, fp)
+        splicer.db.session.commit()
+        assert (holder.fingerprint, other.fingerprint) == (fp, None)
+
+
+def test_holder_deleted_during_entry_saves_instead_of_failing(app, client, monkeypatch):
+    insert_records = splicer.insert_records
+    calls = []
+
+    def holder_just_deleted(rows, keep_duplicates=False):
+        # o primeiro INSERT perde para um lançamento que some antes da consulta
+        calls.append(keep_duplicates)
+        return [None] if len(calls) == 1 else insert_records(rows, keep_duplicates)
+
+    monkeypatch.setattr(splicer, "insert_records", holder_just_deleted)
+    result = client.post("/entry", data={"company": "ACME", "map": "M1", "device_name": "CTO-1", "splices": "2"})
+    assert result.status_code == 302
+    assert list(records(app).values()) == [splicer.record_fingerprint("ACME", "M1", "CTO-1")]
+
+
+def test_map_device_index_is_dropped_by_migration(app):
+    with app.app_context():
+        splicer.db.session.execute(splicer.text('CREATE INDEX ix_record_map_device_company ON record (map, device, company)'))
+        splicer.migrate_drop_map_device_index()
+        names = {ix["name"] for ix in splicer.inspect(splicer.db.engine).get_indexes("record")}
+    assert "ix_record_map_device_company" not in names
+    assert "ux_record_fingerprint" in names
@@ -0,0 +1,73 @@
+import re
+
+import pytest
+from sqlalchemy import event
+
+import app as splicer
+from conftest import seed_records
+
+# passo do plano que percorre a tabela inteira (mesmo na ordem de um índice) em vez de buscar por ele
+FULL_SCAN = re.compile(r"^SCAN (record|record_daily_rollup)\b")
+
+ROUTES = [
+    "/?company=ACME",
+    "/?splicer=ANA",
+    "/?company=ACME&splicer=ANA&start=2026-01-02T05:00&end=2026-02-01T03:00",
+    "/?map=MAP-1",
+    "/?device=CTO-7",
+    "/export/pdf?company=ACME",
+    "/export/pdf?company=ACME&splicer=ANA&no_values=1",
+    "/export/invoice?company=ACME&start=2026-01-02T05:00&end=2026-02-01T03:00",
+    "/export/excel?company=ACME&start=2026-01-02T05:00",
+]
+
+
+def query_plans(app, run, tables=("record", "record_daily_rollup")):
+    """Executa `run` e devolve (SQL, plano) de cada SELECT que lê uma das `tables`."""
+    statements = []
+    table_re = re.compile(r"\b(%s)\b" % "|".join(tables))
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and table_re.search(statement):
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = splicer.db.engine
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        run()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    plans = []
+    with app.app_context():
+        raw = splicer.db.session.connection().connection.driver_connection
+        for statement, parameters in statements:
+            rows = raw.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+            plans.append((statement, [row[3] for row in rows]))
+    return plans
+
+
+@pytest.fixture
+def seeded(app):
+    with app.app_context():
+        seed_records(3000)
+    return app
+
+
+@pytest.mark.parametrize("url", ROUTES)
+def test_route_queries_use_an_index(seeded, client, url):
+    client.get("/")  # listas dos dropdowns ficam em cache; aqui só interessam as consultas do filtro
+    plans = query_plans(seeded, lambda: client.get(url))
+    assert plans
+    for statement, plan in plans:
+        assert not [step for step in plan if FULL_SCAN.match(step)], f"{url}: {statement}\n{plan}"
+
+
+def test_duplicate_check_uses_fingerprint_index(seeded, client):
+    row = {"company": "ACME", "map": "MAP-1", "device_name": "CTO-1", "splices": 2}
+    plans = query_plans(seeded, lambda: client.post("/entry/batch", json={"rows": [row]}))
+    fingerprint_plans = [plan for statement, plan in plans if "fingerprint IN" in statement]
+    assert fingerprint_plans
+    for plan in fingerprint_plans:
+        assert any("ux_record_fingerprint" in step for step in plan), plan
@@ -0,0 +1,29 @@
+import app as splicer
+from test_indexes import query_plans
+
+
+def add_maps(app, company, names):
+    with app.app_context():
+        splicer.db.session.add_all(splicer.CompanyMap(company=company, name=n) for n in names)
+        splicer.db.session.commit()
+
+
+def maps(client, company, q, limit=20):
+    return client.get("/api/maps", query_string={"company": company, "q": q, "limit": limit}).get_json()["maps"]
+
+
+def test_prefix_search_ignores_case(app, client):
+    add_maps(app, "ACME", ["Rua A", "rua b", "RUA C", "Ruela", "Avenida"])
+    add_maps(app, "NORTE", ["Rua Norte"])
+    assert maps(client, "ACME", "rua") == ["Rua A", "rua b", "RUA C"]
+    assert maps(client, "ACME", "RU") == ["Rua A", "rua b", "RUA C", "Ruela"]
+    assert maps(client, "ACME", "") == ["Avenida", "Rua A", "rua b", "RUA C", "Ruela"]
+    assert maps(client, "ACME", "rua", limit=2) == ["Rua A", "rua b"]
+
+
+def test_prefix_search_uses_the_expression_index(app, client):
+    add_maps(app, "ACME", [f"Map {i}" for i in range(200)])
+    plans = query_plans(app, lambda: maps(client, "ACME", "map 1"), tables=("company_map",))
+    plan = [step for statement, steps in plans for step in steps]
+    assert any("ix_company_map_company_lname" in step for step in plan), plan
+    assert not [step for step in plan if step.startswith("SCAN company_map")], plan
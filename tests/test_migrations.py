@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import exc, text
+
+import app as splicer
+
+
+@pytest.fixture
+def fresh_app(tmp_path):
+    app = splicer.create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'fresh.db'}",
+        "EXPORT_WORKERS": 0,
+    })
+    yield app
+    with app.app_context():
+        splicer.db.engine.dispose()
+
+
+def has_fts(app):
+    with app.app_context():
+        return splicer.db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'record_fts'"
+        )).first() is not None
+
+
+def test_failed_search_index_is_not_marked_applied(fresh_app, monkeypatch):
+    execute = splicer.db.session.execute
+
+    def no_fts5(statement, *args, **kwargs):
+        if "fts5" in str(statement):
+            raise exc.OperationalError(str(statement), {}, Exception("no such module: fts5"))
+        return execute(statement, *args, **kwargs)
+
+    with fresh_app.app_context():
+        monkeypatch.setattr(splicer.db.session, "execute", no_fts5)
+        with pytest.raises(exc.OperationalError):
+            splicer.migrate_schema()
+        monkeypatch.undo()
+        assert splicer.schema_version() == 3
+    assert not has_fts(fresh_app)
+
+    # com o FTS5 disponível, o próximo migrate aplica o passo
+    with fresh_app.app_context():
+        assert splicer.migrate_schema()[0] == 4
+        assert splicer.schema_version() == splicer.SCHEMA_VERSION
+    assert has_fts(fresh_app)
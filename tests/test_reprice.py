@@ -0,0 +1,52 @@
+import pytest
+
+import app as splicer
+from conftest import seed_records
+
+
+@pytest.fixture
+def acme(app):
+    """ACME com preço novo de CTO: os lançamentos semeados ficam todos desatualizados."""
+    with app.app_context():
+        seed_records(300)
+        company = splicer.CompanyConfig(name="ACME")
+        splicer.db.session.add_all([company, splicer.DeviceType(name="CTO", value_usd=25.0, company="ACME")])
+        splicer.bump_version("pricing")
+        splicer.db.session.commit()
+        return company.id
+
+
+def rollup_matches_records(app):
+    with app.app_context():
+        filt = splicer.RecordFilter(company="ACME")
+        rollup = splicer.filter_totals(filt)
+        assert rollup == splicer.record_totals(filt.query())
+        return rollup
+
+
+def test_reprice_runs_as_a_job(app, client, acme):
+    before = rollup_matches_records(app)
+    client.post(f"/settings/company/{acme}/reprice", data={})
+
+    with app.app_context():
+        (job,) = splicer.ExportJob.query.filter_by(kind="reprice").all()
+        assert (job.status, job.progress) == ("done", 100)
+        with open(job.file_path, encoding="utf-8") as fh:
+            assert fh.read().startswith("Reprecificação concluída: 150 lançamentos lidos, 150 alterados")
+    assert rollup_matches_records(app)["amount"] != before["amount"]
+    assert f"#{job.id}" in client.get(f"/settings/company/{acme}").get_data(as_text=True)
+
+
+def test_interrupted_reprice_keeps_rollup_consistent(app, acme):
+    def stop_after_first_chunk(fraction):
+        raise RuntimeError("worker morto")
+
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            splicer.reprice_records("ACME", chunk_size=40, progress=stop_after_first_chunk)
+        assert splicer.Record.query.filter_by(company="ACME", price_device_usd=25.0).count() > 0
+    rollup_matches_records(app)
+
+
+def test_reprice_is_not_a_public_export_kind(client, acme):
+    assert client.post("/export/jobs", data={"kind": "reprice", "company": "ACME"}).status_code == 400
@@ -0,0 +1,79 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import exc, insert, text
+
+import app as splicer
+
+R = splicer.RecordDailyRollup
+
+
+def totals_match(filt):
+    rollup = splicer.filter_totals(filt)
+    raw = splicer.record_totals(filt.query())
+    assert rollup == raw
+    return rollup
+
+
+def entry(client, device, created="2026-03-10"):
+    client.post("/entry", data={"company": "ACME", "map": "M1", "device_name": device, "type": "CTO",
+                                "splices": "4", "created": created})
+
+
+def test_delete_and_reinsert_same_day_keep_one_row_per_key(app, client):
+    entry(client, "CTO-1")
+    with app.app_context():
+        (rid,) = [r.id for r in splicer.Record.query]
+    client.get(f"/record/{rid}/delete")
+    entry(client, "CTO-1")
+    entry(client, "CTO-2")
+
+    with app.app_context():
+        totals = totals_match(splicer.RecordFilter(company="ACME"))
+        assert (totals["rows"], totals["splices"]) == (2, 8)
+        assert R.query.filter_by(device="CTO-1").count() == 1
+        # chave sem lançamentos fica com contagem zero, mas some das linhas agrupadas
+        cto2 = splicer.Record.query.filter_by(device="CTO-2").one().id
+        client.get(f"/record/{cto2}/delete")
+        assert [line["device"] for line in splicer.invoice_lines(splicer.RecordFilter(company="ACME"))] == ["CTO-1"]
+        assert splicer.excel_stats(splicer.RecordFilter(company="ACME"))["devices"] == 1
+
+
+def test_undated_records_share_one_row(app):
+    with app.app_context():
+        recs = [splicer.Record(company="ACME", map="M1", device="CTO-1", splices=2, splicer="ANA") for _ in range(3)]
+        splicer.db.session.add_all(recs)
+        splicer.rollup_apply_many(recs[:2])
+        splicer.rollup_apply(recs[2])
+        splicer.rollup_apply(recs[0], -1)
+        splicer.db.session.commit()
+        assert [(r.day, r.record_count, r.splices) for r in R.query] == [(None, 2, 4)]
+
+
+def test_rollup_key_is_unique(app):
+    row = dict(day=date(2026, 3, 10), company="ACME", splicer="ANA", map="M1", device="CTO-1", record_count=1)
+    with app.app_context():
+        splicer.db.session.execute(insert(R), [row])
+        with pytest.raises(exc.IntegrityError):
+            splicer.db.session.execute(insert(R), [row])
+
+
+def test_migration_merges_split_rows(app):
+    with app.app_context():
+        splicer.db.session.execute(text("DROP INDEX ux_rollup_key"))
+        rec = splicer.Record(company="ACME", map="M1", device="CTO-1", splices=4, splicer="ANA",
+                             total_usd=10.0, created_date=datetime(2026, 3, 10))
+        splicer.db.session.add(rec)
+        # delta dividido entre linhas da mesma chave: -1, +1, +1 (um lançamento, excluído e relançado)
+        key = dict(day=date(2026, 3, 10), company="ACME", splicer="ANA", map="M1", device="CTO-1")
+        splicer.db.session.execute(insert(R), [
+            dict(key, record_count=-1, splices=-4, total_usd=-10.0),
+            dict(key, record_count=1, splices=4, total_usd=10.0),
+            dict(key, record_count=1, splices=4, total_usd=10.0),
+        ])
+        splicer.db.session.commit()
+
+        splicer.migrate_rollup_unique_key()
+        assert R.query.count() == 1
+        totals = totals_match(splicer.RecordFilter(company="ACME"))
+        assert (totals["rows"], totals["amount"]) == (1, 10.0)
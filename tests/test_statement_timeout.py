@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import app as splicer
+
+
+class PostgresConnection:
+    dialect = SimpleNamespace(name="postgresql")
+
+    def __init__(self):
+        self.statements = []
+
+    def exec_driver_sql(self, sql):
+        self.statements.append(sql)
+
+
+def begin():
+    conn = PostgresConnection()
+    splicer.request_statement_timeout(splicer.db.session, None, conn)
+    return conn.statements
+
+
+def test_web_requests_get_the_timeout(app):
+    with app.test_request_context("/"):
+        assert begin() == ["SET LOCAL statement_timeout = 60000"]
+
+
+def test_cli_and_workers_run_without_timeout(app):
+    with app.app_context():
+        assert begin() == []
+
+
+def test_migration_inside_a_request_runs_without_timeout(app):
+    with app.test_request_context("/"):
+        splicer.g.migrating = True
+        assert begin() == []
+
+
+def test_zero_disables_the_timeout(app):
+    app.config["DB_STATEMENT_TIMEOUT_MS"] = 0
+    with app.test_request_context("/"):
+        assert begin() == []
+
+
+def test_engine_has_no_connect_time_timeout():
+    assert "connect_args" not in splicer.engine_options("postgresql://db/splicer")